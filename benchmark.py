@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""Benchmark local del pipeline con datos sintéticos y el backend simulado (no consume cuota de la API).
+
+Mide lectura del Excel, limpieza de HTML, enriquecimiento (ítems/minuto), enriquecimiento con lectura
+por bloques (segundos hasta el primer ítem), exportación en cada formato (y su repetición sin cambios),
+ensamblaje de fichas (fichas/segundo), reensamblaje incremental tras modificar el 1% de las filas
+y construcción del .zip con y sin compresión.
+
+Ejemplo:
+    python benchmark.py --filas 10 1000 10000 --latencia 0.05 --salida-json benchmark.json
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import zipfile
+from io import BytesIO
+
+import pandas as pd
+
+import pipeline
+from instrumentacion import RegistroEjecucion
+
+ETAPAS = ("excel", "limpieza", "enriquecimiento", "bloques", "exportacion", "ensamblaje", "reensamblaje", "zip")
+
+FRAGMENTOS_HTML = [
+    "<p>El <strong>agua</strong> cubre la mayor parte del planeta.</p>",
+    "<div><span style='color:red'>Observa</span> la <em>gráfica</em> y responde.</div>",
+    "<p>Según el texto, ¿cuál es la <u>idea principal</u>?<br/></p>",
+    "<ul><li>Primera afirmación</li><li>Segunda afirmación</li></ul>",
+    "Texto sin etiquetas con <b>negrita</b> al final.",
+]
+
+
+def filas_sinteticas(n, semilla=0):
+    """DataFrame con `n` ítems sintéticos con HTML, con las columnas que usan los prompts y la plantilla."""
+    aleatorio = random.Random(semilla)
+
+    def html(fragmentos):
+        return " ".join(aleatorio.choice(FRAGMENTOS_HTML) for _ in range(fragmentos))
+
+    return pd.DataFrame({
+        "ItemId": [f"ITEM{i:06d}" for i in range(n)],
+        "ItemContexto": [html(6) for _ in range(n)],
+        "ItemEnunciado": [html(2) for _ in range(n)],
+        "ComponenteNombre": [aleatorio.choice(["Lectura literal", "Lectura inferencial", "Lectura crítica"]) for _ in range(n)],
+        "CompetenciaNombre": ["Comprensión lectora"] * n,
+        "AfirmacionNombre": [html(1) for _ in range(n)],
+        "EvidenciaNombre": [html(1) for _ in range(n)],
+        "Tipologia Textual": [aleatorio.choice(["Continuo", "Discontinuo", "No aplica"]) for _ in range(n)],
+        "ItemGradoId": [aleatorio.choice([3, 5, 7, 9, 11]) for _ in range(n)],
+        "Analisis_Errores": [html(1) for _ in range(n)],
+        "AlternativaClave": [aleatorio.choice("ABCD") for _ in range(n)],
+        "OpcionA": [html(1) for _ in range(n)],
+        "OpcionB": [html(1) for _ in range(n)],
+        "OpcionC": [html(1) for _ in range(n)],
+        "OpcionD": [html(1) for _ in range(n)],
+    })
+
+
+def plantilla_sintetica():
+    """Plantilla .docx mínima con los campos de la ficha, generada con python-docx."""
+    from docx import Document
+
+    documento = Document()
+    documento.add_heading("Ficha técnica {{ ItemId }}", level=1)
+    for campo in ["ItemEnunciado", "ComponenteNombre", "CompetenciaNombre", "AlternativaClave"] + pipeline.COLUMNAS_NUEVAS:
+        documento.add_paragraph(f"{campo}: {{{{ {campo} }}}}")
+    buffer = BytesIO()
+    documento.save(buffer)
+    return buffer.getvalue()
+
+
+def _cronometrar(funcion, *args, **kwargs):
+    """Ejecuta la función y retorna (resultado, segundos)."""
+    inicio = time.perf_counter()
+    resultado = funcion(*args, **kwargs)
+    return resultado, time.perf_counter() - inicio
+
+
+def ejecutar_benchmark(n, args, directorio, plantilla_bytes):
+    """Corre las etapas seleccionadas con `n` filas y retorna {etapa: métricas}."""
+    resultados = {}
+    ruta_excel = os.path.join(directorio, f"entrada_{n}.xlsx")
+    filas_sinteticas(n, args.semilla).to_excel(ruta_excel, index=False)
+
+    # La lectura y la limpieza se miden con la traza de `preparar_dataframe`, igual que en producción.
+    columnas = pipeline.columnas_usadas(plantilla_bytes)
+    registro = RegistroEjecucion()
+    df = pipeline.preparar_dataframe(ruta_excel, registro, columnas)
+    etapas = registro.resumen()["etapas"]
+    segundos_carga = etapas["lectura_excel"]["total"] + etapas["limpieza_html"]["total"]
+    for etapa, nombre_traza in (("excel", "lectura_excel"), ("limpieza", "limpieza_html")):
+        if etapa in args.etapas:
+            segundos = etapas[nombre_traza]["total"]
+            resultados[etapa] = {"segundos": segundos, "filas_por_segundo": n / segundos}
+
+    def enriquecer(funcion, datos):
+        """Enriquece con el backend simulado; retorna (df, segundos, segundos hasta el primer ítem, llamadas)."""
+        model = pipeline.crear_modelo(
+            "simulado", latencia=args.latencia, jitter=args.jitter, tasa_error=args.tasa_error,
+            tasa_malformada=args.tasa_malformada, semilla=args.semilla,
+        )
+        inicio = time.perf_counter()
+        primero = []
+
+        def al_completar(*_):
+            if not primero:
+                primero.append(time.perf_counter() - inicio)
+
+        df_enriquecido = funcion(
+            model, datos, None, args.trabajadores, al_completar=al_completar, tamano_lote=args.tamano_lote,
+            reintentos=pipeline.PoliticaReintentos(espera_base=0.01, espera_maxima=0.1),
+            streaming=pipeline.ConfiguracionStreaming() if args.streaming else None,
+        )
+        return df_enriquecido, time.perf_counter() - inicio, primero[0] if primero else None, model.llamadas
+
+    if "enriquecimiento" in args.etapas:
+        df, segundos, primer_item, llamadas = enriquecer(pipeline.enriquecer_dataframe, df)
+        resultados["enriquecimiento"] = {
+            "segundos": segundos, "items_por_minuto": n * 60 / segundos, "llamadas": llamadas,
+            "items_con_error": len(pipeline.filas_fallidas(df)),
+            # Incluye la lectura y la limpieza, para compararlo con la lectura por bloques.
+            "segundos_primer_item": segundos_carga + primer_item if primer_item is not None else None,
+        }
+
+    if "bloques" in args.etapas:
+        bloques = pipeline.leer_excel_por_bloques(ruta_excel, args.bloques_lectura, columnas=columnas)
+        _, segundos, primer_item, llamadas = enriquecer(pipeline.enriquecer_por_bloques, bloques)
+        resultados["bloques"] = {
+            "segundos": segundos, "items_por_minuto": n * 60 / segundos, "llamadas": llamadas,
+            "segundos_primer_item": primer_item,
+        }
+
+    if "exportacion" in args.etapas:
+        # Cada formato disponible por separado, y la repetición con los mismos datos (sin volver a codificar).
+        registro_exportacion = RegistroEjecucion()
+        ruta_base = os.path.join(directorio, f"salida_{n}")
+        formatos = pipeline.formatos_disponibles()
+        pipeline.exportar_formatos(df, ruta_base, formatos, registro_exportacion)
+        etapas_exportacion = registro_exportacion.resumen()["etapas"]
+        segundos = etapas_exportacion["exportacion_excel"]["total"]
+        resultados["exportacion"] = {"segundos": segundos, "filas_por_segundo": n / segundos}
+        for formato in formatos[1:]:
+            resultados["exportacion"][f"segundos_{formato}"] = etapas_exportacion[f"exportacion_{formato}"]["total"]
+        _, resultados["exportacion"]["segundos_sin_cambios"] = _cronometrar(pipeline.exportar_formatos, df, ruta_base, formatos)
+
+    if any(etapa in args.etapas for etapa in ("ensamblaje", "reensamblaje", "zip")):
+        ruta_zip = os.path.join(directorio, f"fichas_{n}.zip")
+        _, segundos = _cronometrar(
+            pipeline.ensamblar_fichas, df, plantilla_bytes, "ItemId", ruta_zip,
+            procesos=args.procesos, compresion=zipfile.ZIP_STORED,
+        )
+        if "ensamblaje" in args.etapas:
+            resultados["ensamblaje"] = {"segundos": segundos, "fichas_por_segundo": n / segundos, "procesos": args.procesos}
+
+        if "reensamblaje" in args.etapas:
+            modificado = df.copy()
+            filas = modificado.index[::100]
+            modificado.loc[filas, "Que_Evalua"] = "Este ítem evalúa una versión corregida de la síntesis."
+            conteo, segundos = _cronometrar(
+                pipeline.ensamblar_fichas, modificado, plantilla_bytes, "ItemId", os.path.join(directorio, f"fichas_{n}_v2.zip"),
+                procesos=args.procesos, compresion=zipfile.ZIP_STORED, previo=ruta_zip,
+            )
+            resultados["reensamblaje"] = {"segundos": segundos, "fichas_por_segundo": n / segundos, **conteo}
+
+        if "zip" in args.etapas:
+            with zipfile.ZipFile(ruta_zip) as origen:
+                documentos = [(nombre, origen.read(nombre)) for nombre in origen.namelist()]
+            for etiqueta, compresion in (("deflated", zipfile.ZIP_DEFLATED), ("stored", zipfile.ZIP_STORED)):
+                ruta = os.path.join(directorio, f"zip_{etiqueta}_{n}.zip")
+
+                def escribir():
+                    with zipfile.ZipFile(ruta, "w", compresion, False) as zip_file:
+                        for nombre, documento in documentos:
+                            zip_file.writestr(nombre, documento)
+
+                _, segundos = _cronometrar(escribir)
+                resultados[f"zip_{etiqueta}"] = {
+                    "segundos": segundos, "fichas_por_segundo": n / segundos, "megabytes": os.path.getsize(ruta) / 2**20,
+                }
+    return resultados
+
+
+def construir_parser():
+    """Define los argumentos de la línea de comandos."""
+    parser = argparse.ArgumentParser(description="Benchmark local del pipeline con el backend simulado.")
+    parser.add_argument("--filas", type=int, nargs="+", default=[10, 1000, 10000], help="Tamaños de los conjuntos sintéticos.")
+    parser.add_argument("--etapas", nargs="+", choices=ETAPAS, default=list(ETAPAS), help="Etapas a medir.")
+    parser.add_argument("--latencia", type=float, default=0.0, help="Segundos de latencia por llamada simulada.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Segundos máximos de latencia aleatoria adicional.")
+    parser.add_argument("--tasa-error", type=float, default=0.0, help="Fracción de llamadas que fallan con un error transitorio.")
+    parser.add_argument("--tasa-malformada", type=float, default=0.0, help="Fracción de respuestas sin los separadores esperados.")
+    parser.add_argument("--streaming", action="store_true", help="Consume las respuestas simuladas por fragmentos.")
+    parser.add_argument("--trabajadores", type=int, default=8, help="Ítems procesados en paralelo.")
+    parser.add_argument("--tamano-lote", type=int, default=1, help="Ítems por solicitud en modo por lotes (1 = desactivado).")
+    parser.add_argument("--bloques-lectura", type=int, default=500, help="Filas por bloque en la etapa de lectura por bloques.")
+    parser.add_argument("--procesos", type=int, default=os.cpu_count() or 1, help="Procesos para renderizar las fichas.")
+    parser.add_argument("--semilla", type=int, default=0, help="Semilla de los datos sintéticos y del backend simulado.")
+    parser.add_argument("--salida-json", help="Guarda los resultados en este archivo JSON.")
+    return parser
+
+
+def main(argv=None):
+    args = construir_parser().parse_args(argv)
+    plantilla_bytes = plantilla_sintetica()
+    resultados = {}
+    with tempfile.TemporaryDirectory(prefix="benchmark_fichas_") as directorio:
+        for n in args.filas:
+            print(f"--- {n} filas ---", file=sys.stderr)
+            resultados[n] = ejecutar_benchmark(n, args, directorio, plantilla_bytes)
+            for etapa, metricas in resultados[n].items():
+                detalle = " · ".join(f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}" for k, v in metricas.items())
+                print(f"{etapa:<16} {detalle}", file=sys.stderr)
+
+    if args.salida_json:
+        with open(args.salida_json, "w", encoding="utf-8") as f:
+            json.dump({"parametros": vars(args), "resultados": resultados}, f, ensure_ascii=False, indent=2)
+        print(f"Resultados guardados en {args.salida_json}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
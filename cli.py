@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""Punto de entrada por línea de comandos para enriquecer un Excel y ensamblar fichas sin Streamlit.
+
+Ejemplo:
+    python cli.py datos.xlsx --plantilla plantilla.docx --salida-excel enriquecido.xlsx --salida-zip fichas.zip
+"""
+
+import argparse
+import os
+import sys
+import zipfile
+
+import pipeline
+from instrumentacion import RegistroEjecucion
+
+
+def construir_parser():
+    """Define los argumentos de la línea de comandos."""
+    parser = argparse.ArgumentParser(description="Enriquece ítems con IA y ensambla fichas técnicas en lote.")
+    parser.add_argument("excel", help="Excel de entrada (.xlsx) con los datos base.")
+    parser.add_argument("--plantilla", help="Plantilla de Word (.docx) para ensamblar las fichas.")
+    parser.add_argument("--salida-excel", default="excel_enriquecido_con_ia.xlsx", help="Ruta del Excel enriquecido.")
+    parser.add_argument("--formatos", nargs="+", choices=tuple(pipeline.FORMATOS_EXPORTACION), default=["xlsx"],
+                        help="Formatos de los datos enriquecidos, con la ruta de --salida-excel y su extensión (parquet requiere pyarrow).")
+    parser.add_argument("--salida-zip", default="fichas_tecnicas_generadas.zip", help="Ruta del .zip con las fichas.")
+    parser.add_argument("--columna-nombre", default="ItemId", help="Columna usada para nombrar cada ficha.")
+    parser.add_argument("--api-key", default=os.environ.get("GOOGLE_API_KEY"), help="Clave API de Gemini (por defecto GOOGLE_API_KEY).")
+    parser.add_argument("--clave", action="append", default=[], metavar="PROVEEDOR:CLAVE[:MODELO]",
+                        help="Clave adicional para el pool de clientes (repetible), p. ej. openai:sk-...:gpt-4o-mini.")
+    parser.add_argument("--nivel", action="append", default=[], metavar="PASO:MODELO[:TEMPERATURA[:MAX_TOKENS]]",
+                        help="Modelo de Gemini y configuración de un paso (repetible), p. ej. paso2:gemini-1.5-flash-latest:0.3:256.")
+    parser.add_argument("--backend", choices=("gemini", "simulado"), default="gemini", help="Backend del modelo; \"simulado\" no consume cuota.")
+    parser.add_argument("--trabajadores", type=int, default=8, help="Ítems procesados en paralelo.")
+    parser.add_argument("--rpm", type=int, default=60, help="Solicitudes por minuto de cada clave.")
+    parser.add_argument("--tpm", type=int, default=1_000_000, help="Tokens por minuto de cada clave.")
+    parser.add_argument("--reintentos", type=int, default=4, help="Reintentos por paso ante errores transitorios (429/5xx).")
+    parser.add_argument("--tamano-lote", type=int, default=1, help=f"Ítems por solicitud en modo por lotes (1 = desactivado, máximo {pipeline.TAMANO_LOTE_MAXIMO}).")
+    parser.add_argument("--procesos-ensamblaje", type=int, default=os.cpu_count() or 1, help="Procesos para renderizar las fichas.")
+    parser.add_argument("--ensamblar-todo", action="store_true",
+                        help="Regenera todas las fichas aunque el .zip de salida anterior tenga fichas sin cambios.")
+    parser.add_argument("--zip-sin-compresion", action="store_true", help="Guarda las fichas en el .zip sin recomprimir (ZIP_STORED).")
+    parser.add_argument("--omitir-cache", action="store_true", help="No leer respuestas de la caché.")
+    parser.add_argument("--sin-reanudar", action="store_true", help="Descarta el checkpoint y procesa desde cero.")
+    parser.add_argument("--solo-fallidas", action="store_true", help="Reprocesa solo las filas marcadas con error.")
+    parser.add_argument("--bloques-lectura", type=int, default=0,
+                        help="Lee el Excel en bloques de N filas y empieza a enriquecer sin esperar el libro completo (0 = desactivado).")
+    parser.add_argument("--sin-deduplicar", action="store_true", help="Procesa cada fila aunque repita las entradas de otra.")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Consume las respuestas por fragmentos y cancela antes las que pierden la estructura esperada.")
+    parser.add_argument("--solo-ensamblar", action="store_true", help="Omite el enriquecimiento; el Excel ya está enriquecido.")
+    return parser
+
+
+def main(argv=None):
+    args = construir_parser().parse_args(argv)
+
+    registro = RegistroEjecucion()
+    plantilla_bytes = None
+    if args.plantilla:
+        with open(args.plantilla, "rb") as f:
+            plantilla_bytes = f.read()
+    # Solo se limpia el HTML de las columnas que leen los prompts y la plantilla.
+    columnas = pipeline.columnas_usadas(plantilla_bytes)
+    por_bloques = args.bloques_lectura > 0 and not args.solo_ensamblar
+    if por_bloques:
+        df = pipeline.leer_excel_por_bloques(args.excel, args.bloques_lectura, registro, columnas)
+    else:
+        df = pipeline.preparar_dataframe(args.excel, registro, columnas)
+        print(f"{len(df)} filas cargadas desde {args.excel}", file=sys.stderr)
+
+    if not args.solo_ensamblar:
+        try:
+            niveles = pipeline.parsear_niveles(args.nivel)
+            pipeline.validar_formatos(args.formatos)
+            if args.backend == "simulado":
+                especificaciones = [{"proveedor": "simulado"}]
+            else:
+                especificaciones = [{"proveedor": "gemini", "clave": args.api_key}] if args.api_key else []
+                especificaciones += pipeline.parsear_clientes(args.clave)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 2
+        if not especificaciones:
+            print("Falta la clave API: usa --api-key, --clave o la variable GOOGLE_API_KEY.", file=sys.stderr)
+            return 2
+        # Cada clave tiene su propio limitador dentro del pool de su nivel; no se usa un limitador global.
+        model = pipeline.crear_modelos_por_paso(especificaciones, args.rpm, args.tpm, niveles)
+        with open(args.excel, "rb") as f:
+            checkpoint = pipeline.CheckpointEnriquecimiento.para_libro(f.read())
+        if args.sin_reanudar and not args.solo_fallidas:
+            checkpoint.descartar()
+
+        def mostrar_item_completado(i, item_id, resultado, error):
+            estado = "OK" if error is None else f"ERROR: {error}"
+            print(f"Ítem {item_id}: {estado}", file=sys.stderr)
+
+        estadisticas_lote = pipeline.EstadisticasLote()
+        plan_deduplicacion = pipeline.PlanDeduplicacion()
+        enriquecer = pipeline.enriquecer_por_bloques if por_bloques else pipeline.enriquecer_dataframe
+        df = enriquecer(
+            model, df, None, args.trabajadores,
+            al_completar=mostrar_item_completado,
+            cache=pipeline.CacheRespuestas(), leer_cache=not args.omitir_cache,
+            checkpoint=checkpoint, solo_fallidas=args.solo_fallidas,
+            tamano_lote=args.tamano_lote, estadisticas_lote=estadisticas_lote,
+            reintentos=pipeline.PoliticaReintentos(max_reintentos=args.reintentos), registro=registro,
+            deduplicar=not args.sin_deduplicar, plan_deduplicacion=plan_deduplicacion,
+            streaming=pipeline.ConfiguracionStreaming() if args.streaming else None,
+        )
+        resumen_dedup = plan_deduplicacion.resumen()
+        if resumen_dedup["filas_duplicadas"]:
+            print(
+                f"Deduplicación: {resumen_dedup['filas_duplicadas']} filas repetidas reutilizaron el resultado de "
+                f"{resumen_dedup['unidades_unicas']} ítems únicos (~{resumen_dedup['llamadas_ahorradas']} llamadas ahorradas).",
+                file=sys.stderr,
+            )
+        if len(especificaciones) > 1:
+            for cliente in model.estadisticas():
+                print(
+                    f"Cliente {cliente['cliente']} ({cliente['modelo']}, {cliente['niveles']}): {cliente['solicitudes']} solicitudes, "
+                    f"{cliente['errores']} errores ({cliente['errores_cuota']} de cuota)"
+                    f"{'; deshabilitado por credenciales rechazadas' if cliente['deshabilitado'] else ''}.",
+                    file=sys.stderr,
+                )
+        if args.tamano_lote > 1:
+            resumen_lote = estadisticas_lote.resumen()
+            print(
+                f"Modo por lotes: ~{resumen_lote['tokens_ahorrados']} tokens ahorrados, "
+                f"{resumen_lote['solicitudes_ahorradas']} solicitudes menos, "
+                f"{resumen_lote['elementos_fallback']} elementos reintentados individualmente.",
+                file=sys.stderr,
+            )
+        # Los formatos ya escritos con los mismos datos (por ejemplo, al repetir con --solo-fallidas) no se regeneran.
+        exportacion = pipeline.exportar_formatos(df, os.path.splitext(args.salida_excel)[0], args.formatos, registro)
+        for formato, ruta in exportacion["rutas"].items():
+            estado = "sin cambios" if formato in exportacion["reutilizados"] else "guardado"
+            print(f"Datos enriquecidos ({formato}) {estado} en {ruta}", file=sys.stderr)
+
+    if plantilla_bytes is not None:
+        # El .zip anterior se aparta para copiar de él las fichas sin cambios mientras se escribe el nuevo.
+        previo = None
+        if not args.ensamblar_todo and pipeline.cargar_manifiesto(args.salida_zip) is not None:
+            previo = args.salida_zip + ".anterior"
+            os.replace(args.salida_zip, previo)
+            os.replace(pipeline.ruta_manifiesto(args.salida_zip), pipeline.ruta_manifiesto(previo))
+        try:
+            conteo = pipeline.ensamblar_fichas(
+                df, plantilla_bytes, args.columna_nombre, args.salida_zip, procesos=args.procesos_ensamblaje,
+                compresion=zipfile.ZIP_STORED if args.zip_sin_compresion else zipfile.ZIP_DEFLATED, registro=registro,
+                previo=previo,
+            )
+        except BaseException:
+            if previo is not None:
+                os.replace(previo, args.salida_zip)
+                os.replace(pipeline.ruta_manifiesto(previo), pipeline.ruta_manifiesto(args.salida_zip))
+            raise
+        if previo is not None:
+            os.remove(previo)
+            os.remove(pipeline.ruta_manifiesto(previo))
+        print(
+            f"Fichas guardadas en {args.salida_zip} ({conteo['renderizadas']} generadas, "
+            f"{conteo['reutilizadas']} reutilizadas del .zip anterior)",
+            file=sys.stderr,
+        )
+
+    base_traza = os.path.splitext(args.salida_excel)[0] + "_traza"
+    registro.exportar_json(base_traza + ".json")
+    registro.exportar_csv(base_traza + ".csv")
+    resumen = registro.resumen()
+    for nivel, datos in resumen["por_nivel"].items():
+        p50 = f"{datos['p50']:.2f}s" if datos["p50"] is not None else "—"
+        print(
+            f"Nivel {nivel} ({', '.join(datos['modelos']) or 'caché'}): {datos['llamadas']} llamadas · p50 {p50} · "
+            f"costo ${datos['costo']:.4f}",
+            file=sys.stderr,
+        )
+    print(
+        f"Traza guardada en {base_traza}.json/.csv · {resumen['llamadas']} llamadas · "
+        f"{resumen['tokens']} tokens · costo estimado ${resumen['costo']:.4f}",
+        file=sys.stderr,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""Registro de tiempos, reintentos, tokens y costo estimado de una ejecución del pipeline."""
+
+import csv
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Precios en USD por millón de tokens (entrada, salida); se usan solo para estimar el costo.
+PRECIOS_POR_MILLON = {
+    "gemini-1.5-pro-latest": (1.25, 5.00),
+    "gemini-1.5-flash-latest": (0.075, 0.30),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "simulado": (0.0, 0.0),
+}
+PRECIO_POR_DEFECTO = (1.25, 5.00)
+
+COLUMNAS_TRAZA = [
+    "tipo", "inicio", "item", "paso", "nivel", "modelo", "duracion", "espera_cola", "espera_limitador",
+    "reintentos", "regeneraciones", "cancelaciones", "primer_fragmento", "respuestas", "tokens_entrada", "tokens_salida", "cache",
+    "costo", "estado", "error", "detalle",
+]
+
+def percentil(valores, p):
+    """Percentil `p` (0-100) por interpolación lineal; None si no hay valores."""
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    posicion = (len(ordenados) - 1) * p / 100
+    inferior = int(posicion)
+    superior = min(inferior + 1, len(ordenados) - 1)
+    return ordenados[inferior] + (ordenados[superior] - ordenados[inferior]) * (posicion - inferior)
+
+def costo_estimado(modelo, tokens_entrada, tokens_salida):
+    """Costo estimado en USD de una llamada según `PRECIOS_POR_MILLON`."""
+    precio_entrada, precio_salida = PRECIOS_POR_MILLON.get(modelo, PRECIO_POR_DEFECTO)
+    return (tokens_entrada * precio_entrada + tokens_salida * precio_salida) / 1_000_000
+
+class RegistroEjecucion:
+    """Traza de una ejecución: llamadas al modelo, ítems y etapas (limpieza, render), con resumen y exportación.
+
+    Es seguro usarlo desde varios hilos. El ítem en curso se guarda por hilo, de modo que cada llamada
+    al modelo queda asociada al ítem que la originó.
+    """
+
+    def __init__(self):
+        self.inicio = time.time()
+        self.eventos = []
+        self.lock = threading.Lock()
+        self._local = threading.local()
+
+    def _agregar(self, evento):
+        with self.lock:
+            self.eventos.append(evento)
+
+    def item_actual(self):
+        """Identificador del ítem que procesa el hilo actual, o None."""
+        return getattr(self._local, "item", None)
+
+    @contextmanager
+    def item(self, item_id, encolado=None):
+        """Mide un ítem completo; `encolado` (time.monotonic) permite calcular la espera en cola."""
+        inicio = time.monotonic()
+        self._local.item = item_id
+        estado, error = "ok", None
+        try:
+            yield
+        except Exception as e:
+            estado, error = "error", str(e)
+            raise
+        finally:
+            self._local.item = None
+            duracion = time.monotonic() - inicio
+            self._agregar({
+                "tipo": "item", "inicio": time.time() - duracion, "item": item_id,
+                "duracion": duracion,
+                "espera_cola": inicio - encolado if encolado is not None else 0.0,
+                "estado": estado, "error": error,
+            })
+
+    def registrar_llamada(self, paso, modelo, duracion, espera_limitador=0.0, reintentos=0, regeneraciones=0,
+                          respuestas=0, tokens_entrada=0, tokens_salida=0, cache="fallo", error=None, nivel=None,
+                          cancelaciones=0, primer_fragmento=None):
+        """Registra una llamada (con sus reintentos) a un paso del modelo.
+
+        `nivel` es el nivel de modelo que la atendió, `cancelaciones` las respuestas en streaming cortadas por
+        perder la estructura y `primer_fragmento` los segundos hasta el primer texto visible de la última respuesta.
+        """
+        self._agregar({
+            "tipo": "llamada", "inicio": time.time() - duracion, "item": self.item_actual(), "paso": paso,
+            "nivel": nivel if nivel is not None else paso, "modelo": modelo,
+            "duracion": duracion, "espera_limitador": espera_limitador, "reintentos": reintentos,
+            "regeneraciones": regeneraciones, "cancelaciones": cancelaciones, "primer_fragmento": primer_fragmento,
+            "respuestas": respuestas,
+            "tokens_entrada": tokens_entrada, "tokens_salida": tokens_salida, "cache": cache,
+            "costo": costo_estimado(modelo, tokens_entrada, tokens_salida),
+            "estado": "ok" if error is None else "error", "error": error,
+        })
+
+    def registrar_etapa(self, etapa, duracion, detalle=None):
+        """Registra la duración de una etapa fuera del modelo (lectura, limpieza, render de una ficha...)."""
+        self._agregar({
+            "tipo": "etapa", "inicio": time.time() - duracion, "item": self.item_actual(), "paso": etapa,
+            "duracion": duracion, "detalle": detalle,
+        })
+
+    @contextmanager
+    def medir(self, etapa, detalle=None):
+        """Mide con un bloque `with` la duración de una etapa."""
+        inicio = time.monotonic()
+        try:
+            yield
+        finally:
+            self.registrar_etapa(etapa, time.monotonic() - inicio, detalle)
+
+    def copia_eventos(self):
+        with self.lock:
+            return list(self.eventos)
+
+    def resumen(self):
+        """Métricas agregadas: latencias p50/p95 por paso y por nivel de modelo, tokens por minuto, costo y tasa de fallos de separador."""
+        eventos = self.copia_eventos()
+        llamadas = [e for e in eventos if e["tipo"] == "llamada"]
+        items = [e for e in eventos if e["tipo"] == "item"]
+        transcurrido = max(time.time() - self.inicio, 1e-9)
+        tokens = sum(e["tokens_entrada"] + e["tokens_salida"] for e in llamadas)
+
+        pasos = {}
+        for e in llamadas:
+            pasos.setdefault(e["paso"], []).append(e)
+        por_paso = {}
+        for paso, grupo in sorted(pasos.items(), key=lambda par: str(par[0])):
+            generadas = [e for e in grupo if e["cache"] != "acierto"]
+            respuestas = sum(e["respuestas"] for e in generadas)
+            fallos_separador = sum(e["regeneraciones"] for e in generadas) + sum(
+                1 for e in generadas if e["error"] and "separador" in e["error"]
+            )
+            por_paso[paso] = {
+                "llamadas": len(grupo),
+                "aciertos_cache": len(grupo) - len(generadas),
+                "p50": percentil([e["duracion"] for e in generadas], 50),
+                "p95": percentil([e["duracion"] for e in generadas], 95),
+                "primer_fragmento_p50": percentil(
+                    [e["primer_fragmento"] for e in generadas if e.get("primer_fragmento") is not None], 50
+                ),
+                "reintentos": sum(e["reintentos"] for e in grupo),
+                "cancelaciones": sum(e.get("cancelaciones", 0) for e in grupo),
+                "tasa_fallo_separador": fallos_separador / respuestas if respuestas else 0.0,
+                "tokens_entrada": sum(e["tokens_entrada"] for e in grupo),
+                "tokens_salida": sum(e["tokens_salida"] for e in grupo),
+                "costo": sum(e["costo"] for e in grupo),
+            }
+
+        niveles = {}
+        for e in llamadas:
+            niveles.setdefault(e.get("nivel", e["paso"]), []).append(e)
+        por_nivel = {}
+        for nivel, grupo in sorted(niveles.items(), key=lambda par: str(par[0])):
+            generadas = [e for e in grupo if e["cache"] != "acierto"]
+            por_nivel[nivel] = {
+                "modelos": sorted({e["modelo"] for e in generadas}),
+                "llamadas": len(grupo),
+                "p50": percentil([e["duracion"] for e in generadas], 50),
+                "p95": percentil([e["duracion"] for e in generadas], 95),
+                "tokens_salida": sum(e["tokens_salida"] for e in grupo),
+                "costo": sum(e["costo"] for e in grupo),
+            }
+
+        etapas = {}
+        for e in eventos:
+            if e["tipo"] == "etapa":
+                etapas.setdefault(e["paso"], []).append(e["duracion"])
+
+        return {
+            "transcurrido": transcurrido,
+            "items": len(items),
+            "items_con_error": sum(1 for e in items if e["estado"] == "error"),
+            "items_p50": percentil([e["duracion"] for e in items], 50),
+            "items_p95": percentil([e["duracion"] for e in items], 95),
+            "espera_cola_p95": percentil([e["espera_cola"] for e in items], 95),
+            "llamadas": len(llamadas),
+            "tokens": tokens,
+            "tokens_por_minuto": tokens * 60 / transcurrido,
+            "costo": sum(e["costo"] for e in llamadas),
+            "por_paso": por_paso,
+            "por_nivel": por_nivel,
+            "etapas": {etapa: {"total": sum(d), "n": len(d), "p95": percentil(d, 95)} for etapa, d in etapas.items()},
+        }
+
+    def exportar_json(self, destino):
+        """Escribe el resumen y todos los eventos en JSON (`destino` es una ruta o un archivo de texto)."""
+        datos = {"resumen": self.resumen(), "eventos": self.copia_eventos()}
+        if hasattr(destino, "write"):
+            json.dump(datos, destino, ensure_ascii=False, indent=2, default=str)
+        else:
+            with open(destino, "w", encoding="utf-8") as f:
+                json.dump(datos, f, ensure_ascii=False, indent=2, default=str)
+
+    def exportar_csv(self, destino):
+        """Escribe un evento por fila en CSV (`destino` es una ruta o un archivo de texto)."""
+        def escribir(f):
+            writer = csv.DictWriter(f, fieldnames=COLUMNAS_TRAZA, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(self.copia_eventos())
+        if hasattr(destino, "write"):
+            escribir(destino)
+        else:
+            with open(destino, "w", encoding="utf-8", newline="") as f:
+                escribir(f)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""Backends de modelo intercambiables para el pipeline.
+
+El pipeline solo necesita un objeto con `generate_content(prompt)` que retorne una respuesta con
+atributo `text` (y opcionalmente `usage_metadata`), que es la interfaz de `genai.GenerativeModel`.
+Con `stream=True` debe retornar un iterable de fragmentos con esa misma forma.
+Un backend puede declarar `nombre_modelo` para separar sus respuestas en la caché y en la traza.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+RESPUESTA_PASO1 = """Ruta Cognitiva Correcta:
+Para resolver correctamente este ítem, el estudiante primero debe leer el texto completo e identificar la información relevante para el enunciado. Luego, necesita relacionar esa información con cada una de las opciones de respuesta y descartar las que no se sustentan en el texto. Este proceso le permite reconocer la opción que recoge con precisión lo que el texto afirma, lo que finalmente lo lleva a concluir que la opción clave es la correcta porque es la única que se apoya en la evidencia textual.
+
+Análisis de Opciones No Válidas:
+- **Opción B:** El estudiante podría escoger esta opción si confunde un detalle secundario con la idea central, lo que lo lleva a pensar que cualquier información mencionada responde al enunciado. Sin embargo, esto es incorrecto porque el enunciado pide la información principal.
+- **Opción C:** El estudiante podría escoger esta opción si realiza una inferencia no sustentada, lo que lo lleva a completar el texto con sus propias ideas. Sin embargo, esto es incorrecto porque el texto no ofrece evidencia para ello.
+- **Opción D:** El estudiante podría escoger esta opción si lee de forma fragmentada, lo que lo lleva a tomar una frase aislada como respuesta. Sin embargo, esto es incorrecto porque omite el contexto en el que aparece."""
+
+RESPUESTA_PASO2 = "Este ítem evalúa la capacidad del estudiante para identificar información explícita y relacionarla con el propósito del enunciado."
+
+RESPUESTA_PASO3 = """RECOMENDACIÓN PARA FORTALECER EL APRENDIZAJE EVALUADO EN EL ÍTEM
+Para fortalecer la habilidad de identificar información explícita, se sugiere una dinámica de búsqueda guiada por pistas en textos breves.
+Una actividad que se puede hacer es: se entregan tarjetas con fragmentos de un texto y preguntas que solo se responden con un dato literal; los estudiantes las ordenan oralmente según el orden en que aparece la información.
+Las preguntas orientadoras para esta actividad, entre otras, pueden ser:
+- ¿Qué dato pide exactamente la pregunta?
+- ¿En qué parte del texto aparece ese dato?
+- ¿Qué palabras del texto lo confirman?
+
+RECOMENDACIÓN PARA AVANZAR EN EL APRENDIZAJE EVALUADO EN EL ÍTEM
+Para avanzar desde la identificación de datos explícitos hacia la habilidad de integrar información de varias partes del texto, se sugiere contrastar dos fragmentos que hablan del mismo hecho.
+Una actividad que se puede hacer es: la tarea consiste en leer dos versiones breves de un mismo suceso y señalar oralmente qué información comparten y cuál aporta solo una de ellas.
+Las preguntas orientadoras para esta actividad, entre otras, pueden ser:
+- ¿Qué información se repite en ambos fragmentos?
+- ¿Qué cambia si solo se lee una de las versiones?
+- ¿Cómo se decidió qué información era la más importante?"""
+
+# Respuesta mal formada: larga y sin separadores, como una generación que se desvía del formato.
+RESPUESTA_MALFORMADA = "Respuesta sin la estructura esperada (simulada). " * 600
+
+# Caracteres por fragmento en modo streaming.
+TAMANO_FRAGMENTO = 200
+
+RESPUESTAS_POR_CAMPO = {
+    "analisis_central": RESPUESTA_PASO1,
+    "que_evalua": RESPUESTA_PASO2,
+    "recomendaciones": RESPUESTA_PASO3,
+}
+
+
+class ErrorSimulado(Exception):
+    """Error transitorio inyectado por el backend simulado (se comporta como un 503)."""
+
+    code = 503
+
+
+class ModeloSimulado:
+    """Backend local que responde con textos fijos en el formato que espera cada paso.
+
+    Permite simular latencia (`latencia` segundos más hasta `jitter` aleatorio) e inyectar errores
+    transitorios (`tasa_error`) o respuestas sin separadores (`tasa_malformada`), sin consumir cuota.
+    En streaming la latencia se reparte entre los fragmentos.
+    """
+
+    nombre_modelo = "simulado"
+
+    def __init__(self, latencia=0.0, jitter=0.0, tasa_error=0.0, tasa_malformada=0.0, semilla=None):
+        self.latencia = latencia
+        self.jitter = jitter
+        self.tasa_error = tasa_error
+        self.tasa_malformada = tasa_malformada
+        self.llamadas = 0
+        self._aleatorio = random.Random(semilla)
+        self._lock = threading.Lock()
+
+    def _sortear(self):
+        with self._lock:
+            self.llamadas += 1
+            return self._aleatorio.random(), self._aleatorio.random(), self._aleatorio.random()
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        azar_error, azar_formato, azar_latencia = self._sortear()
+        espera = self.latencia + self.jitter * azar_latencia
+        if espera and not stream:
+            time.sleep(espera)
+        if azar_error < self.tasa_error:
+            raise ErrorSimulado("Servicio no disponible (simulado)")
+
+        texto = self._respuesta_lote(prompt) if "### ÍTEM " in prompt else self._respuesta_individual(prompt)
+        if azar_formato < self.tasa_malformada:
+            texto = RESPUESTA_MALFORMADA
+        uso = SimpleNamespace(prompt_token_count=len(prompt) // 4 + 1, candidates_token_count=len(texto) // 4 + 1)
+        if stream:
+            return self._transmitir(texto, uso, espera)
+        return SimpleNamespace(text=texto, usage_metadata=uso)
+
+    @staticmethod
+    def _transmitir(texto, uso, espera):
+        fragmentos = [texto[k:k + TAMANO_FRAGMENTO] for k in range(0, len(texto), TAMANO_FRAGMENTO)] or [""]
+        for n, fragmento in enumerate(fragmentos, 1):
+            if espera:
+                time.sleep(espera / len(fragmentos))
+            # Como en Gemini, el uso de tokens llega con el último fragmento.
+            yield SimpleNamespace(text=fragmento, usage_metadata=uso if n == len(fragmentos) else None)
+
+    @staticmethod
+    def _respuesta_individual(prompt):
+        if "RECOMENDACIÓN PARA AVANZAR" in prompt:
+            return RESPUESTA_PASO3
+        if "sintetiza análisis complejos" in prompt:
+            return RESPUESTA_PASO2
+        return RESPUESTA_PASO1
+
+    @staticmethod
+    def _respuesta_lote(prompt):
+        campo = next((c for c in RESPUESTAS_POR_CAMPO if f'"{c}"' in prompt), "analisis_central")
+        ids = re.findall(r"### ÍTEM (.+?) ###", prompt)
+        return json.dumps([{"ItemId": item_id, campo: RESPUESTAS_POR_CAMPO[campo]} for item_id in ids], ensure_ascii=False)
+
+
+MODELO_OPENAI = "gpt-4o-mini"
+
+
+class ModeloOpenAI:
+    """Adaptador de la API de chat de OpenAI a la interfaz `generate_content` de Gemini.
+
+    `openai` se importa al crear el cliente. Los reintentos propios del SDK se desactivan para que
+    los errores de cuota lleguen al pool de clientes y a la política de reintentos del pipeline.
+    """
+
+    def __init__(self, api_key, modelo=MODELO_OPENAI, temperatura=0.6, top_p=1, max_tokens=8192, base_url=None):
+        from openai import OpenAI
+
+        self.cliente = OpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+        self.nombre_modelo = modelo
+        self.temperatura = temperatura
+        self.top_p = top_p
+        self.max_tokens = max_tokens
+
+    def generate_content(self, prompt, generation_config=None, stream=False, **kwargs):
+        generacion = generation_config or {}
+        argumentos = dict(
+            model=self.nombre_modelo, messages=[{"role": "user", "content": prompt}],
+            temperature=generacion.get("temperature", self.temperatura), top_p=generacion.get("top_p", self.top_p),
+            max_tokens=generacion.get("max_output_tokens", self.max_tokens),
+        )
+        if stream:
+            return self._transmitir(
+                self.cliente.chat.completions.create(stream=True, stream_options={"include_usage": True}, **argumentos)
+            )
+        respuesta = self.cliente.chat.completions.create(**argumentos)
+        uso = None
+        if respuesta.usage is not None:
+            uso = SimpleNamespace(
+                prompt_token_count=respuesta.usage.prompt_tokens, candidates_token_count=respuesta.usage.completion_tokens
+            )
+        return SimpleNamespace(text=respuesta.choices[0].message.content or "", usage_metadata=uso)
+
+    @staticmethod
+    def _transmitir(respuesta):
+        try:
+            for fragmento in respuesta:
+                texto = (fragmento.choices[0].delta.content or "") if fragmento.choices else ""
+                uso = None
+                if fragmento.usage is not None:
+                    uso = SimpleNamespace(
+                        prompt_token_count=fragmento.usage.prompt_tokens,
+                        candidates_token_count=fragmento.usage.completion_tokens,
+                    )
+                yield SimpleNamespace(text=texto, usage_metadata=uso)
+        finally:
+            respuesta.close()
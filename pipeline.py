@@ -0,0 +1,1871 @@
+# -*- coding: utf-8 -*-
+"""Pipeline de enriquecimiento y ensamblaje de fichas técnicas, independiente de la interfaz.
+
+Este módulo no importa `streamlit` y solo importa `google.generativeai` y `docxtpl` cuando se
+configura el modelo o se ensamblan las fichas, de modo que puede usarse desde la línea de comandos.
+"""
+
+import os
+import re
+import copy
+import json
+import math
+import time
+import random
+import hashlib
+import numbers
+import sqlite3
+import shutil
+import struct
+import zipfile
+import threading
+import multiprocessing
+from itertools import islice
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from io import BytesIO
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+from prompts import (
+    COLUMNAS_PROMPT,
+    construir_prompt_paso1_analisis_central,
+    construir_prompt_paso2_sintesis_que_evalua,
+    construir_prompt_paso3_recomendaciones,
+    construir_prompt_lote_paso1,
+    construir_prompt_lote_paso2,
+    construir_prompt_lote_paso3,
+)
+
+# --- FUNCIONES DE LÓGICA ---
+
+MODELO_NOMBRE = "gemini-1.5-pro-latest"
+GENERATION_CONFIG = {
+    "temperature": 0.6, "top_p": 1, "top_k": 1, "max_output_tokens": 8192
+}
+LIMITE_TOKENS_SALIDA = 8192
+
+# Tokens de salida esperados por ítem en cada paso (texto del campo más el envoltorio JSON en modo por
+# lotes). Un lote no puede pedir más ítems de los que caben en `LIMITE_TOKENS_SALIDA` para el paso más largo.
+TOKENS_SALIDA_POR_ITEM = {"paso1": 1000, "paso2": 150, "paso3": 900}
+TAMANO_LOTE_MAXIMO = LIMITE_TOKENS_SALIDA // max(TOKENS_SALIDA_POR_ITEM.values())
+
+# Nivel de modelo de cada paso: modelo por proveedor y configuración de generación. El paso 2 solo
+# redacta una oración, así que usa un modelo rápido con un tope de salida corto.
+NIVELES_PASO = {
+    "paso1": {"modelos": {"gemini": MODELO_NOMBRE, "openai": "gpt-4o"}, "generacion": GENERATION_CONFIG},
+    "paso2": {
+        "modelos": {"gemini": "gemini-1.5-flash-latest", "openai": "gpt-4o-mini"},
+        "generacion": {**GENERATION_CONFIG, "temperature": 0.3, "max_output_tokens": 256},
+    },
+    "paso3": {"modelos": {"gemini": MODELO_NOMBRE, "openai": "gpt-4o"}, "generacion": GENERATION_CONFIG},
+}
+
+PATRON_HTML = re.compile('<.*?>')
+
+def setup_model(api_key, modelo=MODELO_NOMBRE, cliente_propio=False):
+    """Configura y retorna el cliente para el modelo Gemini.
+
+    `google.generativeai` se importa aquí para no cargarlo mientras no se necesite el modelo.
+    `genai.configure` fija una sola clave para todo el proceso; con `cliente_propio=True` el modelo
+    recibe su propio cliente de la API con `api_key`, para usar varias claves a la vez.
+    """
+    import google.generativeai as genai
+
+    if not cliente_propio:
+        genai.configure(api_key=api_key)
+    safety_settings = [
+        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_ONLY_HIGH"},
+        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_ONLY_HIGH"},
+        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_ONLY_HIGH"},
+        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_ONLY_HIGH"},
+    ]
+    model = genai.GenerativeModel(
+        model_name=modelo,
+        generation_config=GENERATION_CONFIG,
+        safety_settings=safety_settings
+    )
+    if cliente_propio:
+        from google.ai import generativelanguage as glm
+
+        model._client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+    if modelo != MODELO_NOMBRE:
+        model.nombre_modelo = modelo
+    return model
+
+BACKENDS = ("gemini", "openai", "simulado")
+
+def crear_modelo(backend="gemini", api_key=None, **opciones):
+    """Crea el cliente del `backend` indicado.
+
+    "gemini" usa `setup_model(api_key)`; "openai" retorna un `modelos.ModeloOpenAI` con la misma
+    interfaz; "simulado" retorna un `modelos.ModeloSimulado` que no consume cuota y sirve para pruebas
+    y benchmarks. Las `opciones` se pasan al constructor de cada backend.
+    """
+    if backend == "gemini":
+        return setup_model(api_key, **opciones)
+    if backend == "openai":
+        from modelos import ModeloOpenAI
+        return ModeloOpenAI(
+            api_key, temperatura=GENERATION_CONFIG["temperature"], top_p=GENERATION_CONFIG["top_p"],
+            max_tokens=GENERATION_CONFIG["max_output_tokens"], **opciones
+        )
+    if backend == "simulado":
+        from modelos import ModeloSimulado
+        return ModeloSimulado(**opciones)
+    raise ValueError(f"Backend desconocido: {backend!r}. Opciones: {', '.join(BACKENDS)}.")
+
+def nombre_modelo(model):
+    """Nombre del modelo usado en las claves de caché y en la traza; los backends pueden declarar `nombre_modelo`."""
+    return getattr(model, "nombre_modelo", MODELO_NOMBRE)
+
+# --- CACHÉ PERSISTENTE DE RESPUESTAS ---
+
+RUTA_CACHE = os.environ.get("RUTA_CACHE_IA", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache_ia", "respuestas.sqlite"))
+
+class CacheRespuestas:
+    """Caché en SQLite de las respuestas del modelo, indexada por prompt, modelo y configuración de generación."""
+
+    def __init__(self, ruta=RUTA_CACHE, max_megabytes=500, max_dias=30):
+        os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+        self.ruta = ruta
+        self.max_bytes = int(max_megabytes * 1024 * 1024)
+        self.max_segundos = max_dias * 24 * 3600
+        self.aciertos = 0
+        self.fallos = 0
+        self.escrituras = 0
+        self.lock = threading.Lock()
+        self.conexion = sqlite3.connect(ruta, check_same_thread=False)
+        self.conexion.execute(
+            "CREATE TABLE IF NOT EXISTS respuestas ("
+            "clave TEXT PRIMARY KEY, respuesta TEXT NOT NULL, bytes INTEGER NOT NULL, "
+            "creado REAL NOT NULL, accedido REAL NOT NULL)"
+        )
+        self.conexion.commit()
+        self.desalojar()
+
+    @staticmethod
+    def clave(prompt, modelo_nombre, generation_config):
+        """Hash SHA-256 del prompt exacto junto con el modelo y su configuración."""
+        firma = json.dumps({"modelo": modelo_nombre, "config": generation_config}, sort_keys=True)
+        return hashlib.sha256(f"{firma}\n{prompt}".encode("utf-8")).hexdigest()
+
+    def obtener(self, clave):
+        """Retorna la respuesta guardada o None si no existe o ya expiró."""
+        ahora = time.time()
+        with self.lock:
+            fila = self.conexion.execute(
+                "SELECT respuesta, creado FROM respuestas WHERE clave = ?", (clave,)
+            ).fetchone()
+            if fila is None or ahora - fila[1] > self.max_segundos:
+                self.fallos += 1
+                return None
+            self.conexion.execute("UPDATE respuestas SET accedido = ? WHERE clave = ?", (ahora, clave))
+            self.conexion.commit()
+            self.aciertos += 1
+            return fila[0]
+
+    def guardar(self, clave, respuesta):
+        """Guarda una respuesta y desaloja entradas cada cierto número de escrituras."""
+        ahora = time.time()
+        with self.lock:
+            self.conexion.execute(
+                "INSERT OR REPLACE INTO respuestas (clave, respuesta, bytes, creado, accedido) VALUES (?, ?, ?, ?, ?)",
+                (clave, respuesta, len(respuesta.encode("utf-8")), ahora, ahora)
+            )
+            self.conexion.commit()
+            self.escrituras += 1
+            desalojar = self.escrituras % 100 == 0
+        if desalojar:
+            self.desalojar()
+
+    def desalojar(self):
+        """Elimina entradas más antiguas que `max_dias` y, si se supera `max_megabytes`, las menos usadas."""
+        with self.lock:
+            self.conexion.execute("DELETE FROM respuestas WHERE creado < ?", (time.time() - self.max_segundos,))
+            total = self.conexion.execute("SELECT COALESCE(SUM(bytes), 0) FROM respuestas").fetchone()[0]
+            if total > self.max_bytes:
+                exceso = total - self.max_bytes
+                claves = []
+                for clave, bytes_fila in self.conexion.execute("SELECT clave, bytes FROM respuestas ORDER BY accedido ASC"):
+                    if exceso <= 0:
+                        break
+                    claves.append((clave,))
+                    exceso -= bytes_fila
+                self.conexion.executemany("DELETE FROM respuestas WHERE clave = ?", claves)
+            self.conexion.commit()
+
+    def estadisticas(self):
+        """Retorna número de entradas, tamaño en bytes y contadores de aciertos/fallos."""
+        with self.lock:
+            entradas, total = self.conexion.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM respuestas").fetchone()
+        return {"entradas": entradas, "bytes": total, "aciertos": self.aciertos, "fallos": self.fallos}
+
+    def limpiar(self):
+        """Vacía la caché por completo."""
+        with self.lock:
+            self.conexion.execute("DELETE FROM respuestas")
+            self.conexion.commit()
+
+# --- CHECKPOINTS DE ENRIQUECIMIENTO ---
+
+DIRECTORIO_CHECKPOINTS = os.environ.get("DIRECTORIO_CHECKPOINTS", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".checkpoints"))
+
+class CheckpointEnriquecimiento:
+    """Registro durable (JSON Lines) de las filas ya procesadas de un libro de Excel."""
+
+    def __init__(self, ruta):
+        os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+        self.ruta = ruta
+        self.lock = threading.Lock()
+        self._cerrar_linea_truncada()
+
+    def _cerrar_linea_truncada(self):
+        """Garantiza que los nuevos registros no queden pegados a una línea interrumpida."""
+        if not os.path.exists(self.ruta) or os.path.getsize(self.ruta) == 0:
+            return
+        with open(self.ruta, "rb+") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+
+    @classmethod
+    def para_libro(cls, contenido_excel, directorio=DIRECTORIO_CHECKPOINTS):
+        """Checkpoint asociado al contenido exacto del libro de Excel."""
+        huella = hashlib.sha256(contenido_excel).hexdigest()
+        return cls(os.path.join(directorio, f"{huella}.jsonl"))
+
+    def _ultimos_registros(self):
+        """Retorna {indice_fila: registro} con el último registro de cada fila."""
+        registros = {}
+        if not os.path.exists(self.ruta):
+            return registros
+        with open(self.ruta, encoding="utf-8") as f:
+            for linea in f:
+                try:
+                    registro = json.loads(linea)
+                except json.JSONDecodeError:
+                    # Última línea truncada por una interrupción durante la escritura.
+                    continue
+                registros[registro["fila"]] = registro
+        return registros
+
+    def cargar(self):
+        """Retorna {indice_fila: resultado}; si una fila aparece varias veces gana el último registro."""
+        return {i: registro["resultado"] for i, registro in self._ultimos_registros().items()}
+
+    def cargar_parciales(self):
+        """Retorna {indice_fila: salidas_de_pasos} de las filas fallidas que alcanzaron a completar algún paso."""
+        return {
+            i: registro["parciales"]
+            for i, registro in self._ultimos_registros().items()
+            if registro.get("error") and registro.get("parciales")
+        }
+
+    def registrar(self, i, resultado, error=False, parciales=None):
+        """Agrega el resultado de una fila (y las salidas de pasos ya completados si falló) y lo sincroniza a disco."""
+        registro = {"fila": int(i), "error": bool(error), "resultado": resultado}
+        if parciales:
+            registro["parciales"] = parciales
+        linea = json.dumps(registro, ensure_ascii=False)
+        with self.lock:
+            with open(self.ruta, "a", encoding="utf-8") as f:
+                f.write(linea + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def descartar(self):
+        """Elimina el checkpoint para empezar desde cero."""
+        with self.lock:
+            if os.path.exists(self.ruta):
+                os.remove(self.ruta)
+
+    @staticmethod
+    def _copiar(origen, destino):
+        """Copia un archivo de checkpoint de forma atómica (nadie ve una copia a medias)."""
+        temporal = f"{destino}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(origen, temporal)
+        os.replace(temporal, destino)
+
+    def sembrar(self, origen=None):
+        """Inicia este checkpoint con los registros de otro (`origen`), o vacío si no hay origen o no existe."""
+        with self.lock:
+            if origen is not None and os.path.exists(origen.ruta):
+                self._copiar(origen.ruta, self.ruta)
+            else:
+                open(self.ruta, "w").close()
+
+    def publicar(self, destino):
+        """Copia los registros de este checkpoint en `destino` (p. ej. el del libro), reemplazándolo."""
+        with self.lock:
+            if os.path.exists(self.ruta):
+                self._copiar(self.ruta, destino.ruta)
+
+# --- MOTOR DE ENRIQUECIMIENTO CONCURRENTE ---
+
+MARCA_ERROR = "ERROR EN PROCESAMIENTO"
+COLUMNAS_NUEVAS = ["Que_Evalua", "Justificacion_Correcta", "Analisis_Distractores", "Recomendacion_Fortalecer", "Recomendacion_Avanzar"]
+
+class LimitadorTasa:
+    """Limitador token-bucket para solicitudes por minuto (RPM) y tokens por minuto (TPM)."""
+
+    def __init__(self, solicitudes_por_minuto=60, tokens_por_minuto=1_000_000):
+        self.capacidad_solicitudes = float(solicitudes_por_minuto)
+        self.capacidad_tokens = float(tokens_por_minuto)
+        self.solicitudes_disponibles = self.capacidad_solicitudes
+        self.tokens_disponibles = self.capacidad_tokens
+        self.ultima_recarga = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _recargar(self):
+        ahora = time.monotonic()
+        transcurrido = ahora - self.ultima_recarga
+        self.ultima_recarga = ahora
+        self.solicitudes_disponibles = min(self.capacidad_solicitudes, self.solicitudes_disponibles + transcurrido * self.capacidad_solicitudes / 60.0)
+        self.tokens_disponibles = min(self.capacidad_tokens, self.tokens_disponibles + transcurrido * self.capacidad_tokens / 60.0)
+
+    def adquirir(self, tokens=0):
+        """Bloquea hasta que haya cupo para una solicitud de `tokens` tokens y lo consume."""
+        tokens = min(float(tokens), self.capacidad_tokens)
+        while True:
+            with self.lock:
+                self._recargar()
+                if self.solicitudes_disponibles >= 1 and self.tokens_disponibles >= tokens:
+                    self.solicitudes_disponibles -= 1
+                    self.tokens_disponibles -= tokens
+                    return
+                espera = self._espera(tokens)
+            time.sleep(espera)
+
+    def _espera(self, tokens):
+        falta_solicitudes = max(0.0, 1 - self.solicitudes_disponibles) * 60.0 / self.capacidad_solicitudes
+        falta_tokens = max(0.0, tokens - self.tokens_disponibles) * 60.0 / self.capacidad_tokens
+        return max(falta_solicitudes, falta_tokens)
+
+    def espera_estimada(self, tokens=0):
+        """Segundos hasta que haya cupo para `tokens` tokens, sin consumirlo (0 si ya hay cupo)."""
+        tokens = min(float(tokens), self.capacidad_tokens)
+        with self.lock:
+            self._recargar()
+            return self._espera(tokens)
+
+    def holgura(self):
+        """Fracción del cupo disponible (la menor entre solicitudes y tokens)."""
+        with self.lock:
+            self._recargar()
+            return min(self.solicitudes_disponibles / self.capacidad_solicitudes, self.tokens_disponibles / self.capacidad_tokens)
+
+def estimar_tokens(texto):
+    """Estimación aproximada de tokens (~4 caracteres por token)."""
+    return len(texto) // 4 + 1
+
+# --- POOL DE CLIENTES (VARIAS CLAVES Y PROVEEDORES) ---
+
+CODIGOS_CUOTA = {429}
+ERRORES_CUOTA = {"ResourceExhausted", "TooManyRequests", "RateLimitError"}
+
+def es_error_cuota(e):
+    """Indica si un error se debe a la cuota o al límite de tasa de la clave (429)."""
+    codigo = getattr(e, "code", None) or getattr(e, "status_code", None)
+    try:
+        if int(codigo) in CODIGOS_CUOTA:
+            return True
+    except (TypeError, ValueError):
+        pass
+    return type(e).__name__ in ERRORES_CUOTA
+
+CODIGOS_CREDENCIAL = {401, 403}
+ERRORES_CREDENCIAL = {"Unauthenticated", "PermissionDenied", "AuthenticationError", "PermissionDeniedError"}
+
+def es_error_credencial(e):
+    """Indica si un error se debe a una clave inválida, revocada o sin permisos (401/403)."""
+    codigo = getattr(e, "code", None) or getattr(e, "status_code", None)
+    try:
+        if int(codigo) in CODIGOS_CREDENCIAL:
+            return True
+    except (TypeError, ValueError):
+        pass
+    # Gemini responde a una clave inválida con un 400 cuyo motivo es API_KEY_INVALID.
+    return type(e).__name__ in ERRORES_CREDENCIAL or "API_KEY_INVALID" in str(e)
+
+class ClientePool:
+    """Un cliente del pool: su modelo, su limitador de tasa y sus estadísticas de salud."""
+
+    def __init__(self, nombre, model, limitador):
+        self.nombre = nombre
+        self.model = model
+        self.limitador = limitador
+        self.en_curso = 0
+        self.solicitudes = 0
+        self.errores = 0
+        self.errores_cuota = 0
+        self.tasa_error = 0.0
+        self.enfriamientos = 0
+        self.enfriado_hasta = 0.0
+        self.deshabilitado = None
+
+    def carga(self, tokens):
+        """Clave de orden del enrutamiento: espera del limitador, solicitudes en curso por cupo y tasa de error."""
+        return (
+            self.limitador.espera_estimada(tokens), self.en_curso / self.limitador.capacidad_solicitudes,
+            -self.limitador.holgura(), self.tasa_error,
+        )
+
+class PoolClientes:
+    """Reparte las llamadas entre varios clientes (claves o proveedores) detrás de `generate_content`.
+
+    Cada llamada va al cliente disponible con menos carga: el que tiene cupo antes en su propio
+    limitador y menos solicitudes en curso. Un error de cuota (429) enfría al cliente y la llamada
+    pasa de inmediato al siguiente; los demás errores transitorios suben su tasa de error y, si
+    supera `TASA_ERROR_MAXIMA`, también lo enfrían. Los errores del contenido no afectan al cliente. El enfriamiento crece con cada falla seguida y se
+    reinicia con un éxito. Un error de credenciales (401/403) deshabilita al cliente por el resto de
+    la ejecución y la llamada pasa al siguiente. Si todos los clientes fallan en la misma llamada el
+    último error se propaga, y `generar_con_limite` lo reintenta con su política.
+    """
+
+    PESO_ERROR = 0.2
+    TASA_ERROR_MAXIMA = 0.5
+    ENFRIAMIENTO_BASE = 5.0
+    ENFRIAMIENTO_MAXIMO = 120.0
+
+    def __init__(self, clientes):
+        if not clientes:
+            raise ValueError("El pool necesita al menos un cliente.")
+        self.clientes = list(clientes)
+        self.lock = threading.Lock()
+        # Con un solo modelo la caché se comparte con las ejecuciones sin pool.
+        self.nombre_modelo = "+".join(sorted({nombre_modelo(c.model) for c in self.clientes}))
+
+    def _tomar(self, tokens, intentados):
+        """Reserva el cliente con menos carga que no se haya intentado; espera si todos están enfriados."""
+        while True:
+            with self.lock:
+                ahora = time.monotonic()
+                candidatos = [c for c in self.clientes if c not in intentados and c.deshabilitado is None]
+                if not candidatos:
+                    return None
+                disponibles = [c for c in candidatos if c.enfriado_hasta <= ahora]
+                if disponibles:
+                    cliente = min(disponibles, key=lambda c: c.carga(tokens))
+                    cliente.en_curso += 1
+                    return cliente
+                espera = min(c.enfriado_hasta for c in candidatos) - ahora
+            time.sleep(max(0.0, espera))
+
+    def _enfriar(self, cliente):
+        cliente.enfriamientos += 1
+        espera = min(self.ENFRIAMIENTO_MAXIMO, self.ENFRIAMIENTO_BASE * 2 ** (cliente.enfriamientos - 1))
+        cliente.enfriado_hasta = time.monotonic() + espera
+
+    def _registrar(self, cliente, error=None, cancelada=False):
+        """Registra el fin de una llamada y su efecto en la salud del cliente.
+
+        Solo los errores transitorios, de cuota o de credenciales hablan de la salud del cliente. Un error
+        del contenido (400, respuesta bloqueada) o una generación cancelada no cuentan como éxito ni como
+        falla: se resuelven con la política de reintentos del paso.
+        """
+        with self.lock:
+            cliente.en_curso -= 1
+            cliente.solicitudes += 1
+            if cancelada or (error is not None and not es_error_transitorio(error) and not es_error_credencial(error)):
+                return
+            cliente.tasa_error += self.PESO_ERROR * ((0.0 if error is None else 1.0) - cliente.tasa_error)
+            if error is None:
+                cliente.enfriamientos = 0
+                return
+            cliente.errores += 1
+            if es_error_credencial(error):
+                cliente.deshabilitado = error
+            elif es_error_cuota(error):
+                cliente.errores_cuota += 1
+                self._enfriar(cliente)
+            elif cliente.tasa_error > self.TASA_ERROR_MAXIMA:
+                self._enfriar(cliente)
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        """Genera con el cliente de menos carga. Con `stream=True` retorna un iterable de fragmentos; el cambio
+        de cliente ante errores solo ocurre antes del primer fragmento."""
+        tokens = estimar_tokens(prompt)
+        intentados = []
+        ultimo_error = None
+        while True:
+            cliente = self._tomar(tokens, intentados)
+            if cliente is None:
+                raise ultimo_error or next(c.deshabilitado for c in self.clientes if c.deshabilitado is not None)
+            intentados.append(cliente)
+            try:
+                cliente.limitador.adquirir(tokens)
+                if stream:
+                    return self._transmitir(cliente, cliente.model.generate_content(prompt, stream=True, **kwargs))
+                response = cliente.model.generate_content(prompt, **kwargs)
+                texto = response.text
+            except Exception as e:
+                self._registrar(cliente, e)
+                if not es_error_transitorio(e) and not es_error_credencial(e):
+                    raise
+                ultimo_error = e
+                continue
+            self._registrar(cliente)
+            return SimpleNamespace(
+                text=texto, usage_metadata=getattr(response, "usage_metadata", None),
+                nombre_modelo=nombre_modelo(cliente.model), cliente=cliente.nombre,
+            )
+
+    def _transmitir(self, cliente, fragmentos):
+        """Reenvía los fragmentos de un cliente y registra el resultado al terminar o al cancelarse el stream."""
+        error = None
+        cancelada = False
+        try:
+            for fragmento in fragmentos:
+                yield SimpleNamespace(
+                    text=texto_fragmento(fragmento), usage_metadata=getattr(fragmento, "usage_metadata", None),
+                    nombre_modelo=nombre_modelo(cliente.model),
+                )
+        except GeneratorExit:
+            # El consumidor cerró el stream (p. ej. `GeneracionCancelada`): no dice nada de la salud del cliente.
+            cancelada = True
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            cerrar = getattr(fragmentos, "close", None)
+            if cerrar is not None:
+                cerrar()
+            self._registrar(cliente, error, cancelada)
+
+    def estadisticas(self):
+        """Solicitudes, errores, tasa de error y estado de cada cliente."""
+        ahora = time.monotonic()
+        with self.lock:
+            return [
+                {
+                    "cliente": c.nombre, "modelo": nombre_modelo(c.model), "solicitudes": c.solicitudes,
+                    "errores": c.errores, "errores_cuota": c.errores_cuota, "tasa_error": round(c.tasa_error, 3),
+                    "en_curso": c.en_curso, "enfriado_segundos": round(max(0.0, c.enfriado_hasta - ahora), 1),
+                    "deshabilitado": c.deshabilitado is not None,
+                }
+                for c in self.clientes
+            ]
+
+def parsear_clientes(lineas):
+    """Especificaciones de clientes a partir de líneas "proveedor:clave[:modelo]".
+
+    Sin proveedor se asume Gemini; se ignoran las líneas vacías y las que empiezan con "#".
+    """
+    especificaciones = []
+    for linea in lineas:
+        linea = linea.strip()
+        if not linea or linea.startswith("#"):
+            continue
+        partes = [parte.strip() for parte in linea.split(":", 2)]
+        if len(partes) == 1:
+            partes.insert(0, "gemini")
+        proveedor = partes[0].lower()
+        if proveedor not in BACKENDS:
+            raise ValueError(f"Proveedor desconocido: {proveedor!r}. Opciones: {', '.join(BACKENDS)}.")
+        especificacion = {"proveedor": proveedor, "clave": partes[1]}
+        if len(partes) == 3 and partes[2]:
+            especificacion["modelo"] = partes[2]
+        especificaciones.append(especificacion)
+    return especificaciones
+
+def crear_pool(especificaciones, solicitudes_por_minuto=60, tokens_por_minuto=1_000_000, modelos=None, limitadores=None):
+    """Crea un `PoolClientes` con un cliente y un limitador propio por especificación.
+
+    Cada especificación es un dict con "proveedor" y "clave"; "rpm" y "tpm" sustituyen los límites
+    por defecto de ese cliente y el resto de claves (p. ej. "modelo") se pasan a `crear_modelo`.
+    `modelos` ({proveedor: modelo}) fija el modelo de los clientes que no declaran uno propio.
+    Los clientes de Gemini siempre llevan su propio cliente de la API: `genai.configure` es global al
+    proceso, y el trabajador ejecuta en hilos trabajos de personas distintas con claves distintas.
+    `limitadores` ({(proveedor, clave, modelo): LimitadorTasa}) permite que varios pools compartan el
+    cupo de una misma clave y modelo.
+    """
+    limitadores = {} if limitadores is None else limitadores
+    clientes = []
+    for n, especificacion in enumerate(especificaciones, 1):
+        opciones = {k: v for k, v in especificacion.items() if k not in ("proveedor", "clave", "rpm", "tpm")}
+        if modelos and especificacion["proveedor"] in modelos:
+            opciones.setdefault("modelo", modelos[especificacion["proveedor"]])
+        if especificacion["proveedor"] == "gemini":
+            opciones["cliente_propio"] = True
+        model = crear_modelo(especificacion["proveedor"], especificacion.get("clave"), **opciones)
+        # La cuota es por clave y por el modelo que de verdad se llama.
+        limitador = limitadores.setdefault(
+            (especificacion["proveedor"], especificacion.get("clave"), nombre_modelo(model)),
+            LimitadorTasa(especificacion.get("rpm", solicitudes_por_minuto), especificacion.get("tpm", tokens_por_minuto)),
+        )
+        clientes.append(ClientePool(f"{especificacion['proveedor']}-{n}", model, limitador))
+    return PoolClientes(clientes)
+
+# --- NIVELES DE MODELO POR PASO ---
+
+class ModelosPorPaso:
+    """Un cliente (modelo o pool) por nivel, con la configuración de generación de cada paso.
+
+    `generar_con_limite` lo reconoce y envía cada llamada al cliente de su paso. Los pasos con los
+    mismos modelos comparten cliente, y con él los limitadores de cada clave.
+    """
+
+    def __init__(self, modelos, niveles=None):
+        self.modelos = dict(modelos)
+        self.niveles = niveles or NIVELES_PASO
+        self.nombre_modelo = "+".join(sorted({nombre_modelo(m) for m in self.modelos.values()}))
+
+    def para(self, nivel, elementos=1):
+        """Retorna (cliente, configuración de generación) del nivel; `elementos` escala el tope de salida de un lote."""
+        generacion = dict(self.niveles[nivel]["generacion"])
+        generacion["max_output_tokens"] = min(LIMITE_TOKENS_SALIDA, generacion["max_output_tokens"] * max(1, elementos))
+        return self.modelos[nivel], generacion
+
+    def estadisticas(self):
+        """Estadísticas de cada cliente de los pools, con los niveles que atiende."""
+        filas = []
+        vistos = {}
+        for nivel, model in self.modelos.items():
+            vistos.setdefault(id(model), (model, []))[1].append(nivel)
+        for model, niveles in vistos.values():
+            if isinstance(model, PoolClientes):
+                filas.extend({"niveles": ", ".join(niveles), **fila} for fila in model.estadisticas())
+        return filas
+
+def parsear_niveles(lineas, niveles=None):
+    """Aplica a `niveles` (por defecto `NIVELES_PASO`) líneas "paso:modelo[:temperatura[:max_tokens]]".
+
+    El modelo indicado es el de Gemini; un campo vacío conserva el valor actual. Retorna una copia.
+    """
+    niveles = json.loads(json.dumps(niveles or NIVELES_PASO))
+    for linea in lineas:
+        partes = [parte.strip() for parte in linea.split(":")]
+        if partes[0] not in niveles or not 2 <= len(partes) <= 4:
+            raise ValueError(f"Nivel inválido: {linea!r}. Formato: paso:modelo[:temperatura[:max_tokens]] con paso en {', '.join(niveles)}.")
+        nivel = niveles[partes[0]]
+        if partes[1]:
+            nivel["modelos"]["gemini"] = partes[1]
+        try:
+            if len(partes) > 2 and partes[2]:
+                nivel["generacion"]["temperature"] = float(partes[2])
+            if len(partes) > 3 and partes[3]:
+                nivel["generacion"]["max_output_tokens"] = min(LIMITE_TOKENS_SALIDA, int(partes[3]))
+        except ValueError:
+            raise ValueError(f"Nivel inválido: {linea!r}. La temperatura debe ser un número y max_tokens un entero.") from None
+    return niveles
+
+def crear_modelos_por_paso(especificaciones, solicitudes_por_minuto=60, tokens_por_minuto=1_000_000, niveles=None):
+    """Crea un pool por cada combinación distinta de modelos efectivos de los niveles y los reparte entre los pasos.
+
+    Dos niveles comparten pool si llaman a los mismos modelos con las claves dadas (los modelos de
+    proveedores sin clave no cuentan), y cada clave con un mismo modelo usa un solo limitador en
+    todos los pools, para no superar su cupo real.
+    """
+    niveles = niveles or NIVELES_PASO
+    proveedores = {e["proveedor"] for e in especificaciones}
+    pools = {}
+    limitadores = {}
+    modelos = {}
+    for nivel, configuracion in niveles.items():
+        efectivos = {p: m for p, m in configuracion["modelos"].items() if p in proveedores}
+        clave = json.dumps(efectivos, sort_keys=True)
+        if clave not in pools:
+            pools[clave] = crear_pool(especificaciones, solicitudes_por_minuto, tokens_por_minuto, efectivos, limitadores)
+        modelos[nivel] = pools[clave]
+    return ModelosPorPaso(modelos, niveles)
+
+# --- GENERACIÓN EN STREAMING ---
+
+# Separador que debe contener la respuesta de cada paso y caracteres tras los que, si aún no aparece,
+# se cancela la generación. Las respuestas bien formadas lo incluyen mucho antes.
+SEPARADORES_STREAMING = {
+    "paso1": ("Análisis de Opciones No Válidas:", 4000),
+    "paso3": ("RECOMENDACIÓN PARA AVANZAR", 4000),
+}
+
+class GeneracionCancelada(ValueError):
+    """Respuesta en streaming cancelada porque no respeta la estructura esperada; conserva el texto parcial."""
+
+    def __init__(self, mensaje, parcial):
+        super().__init__(mensaje)
+        self.parcial = parcial
+
+def texto_fragmento(fragmento):
+    """Texto de un fragmento del stream; Gemini puede cerrar el stream con un fragmento sin partes de texto."""
+    try:
+        return fragmento.text or ""
+    except ValueError:
+        return ""
+
+class ConfiguracionStreaming:
+    """Generación en streaming con texto parcial visible y cancelación temprana de respuestas mal formadas.
+
+    `al_fragmento(item_id, paso, texto)` recibe el texto acumulado de cada llamada a medida que llega,
+    desde los hilos de trabajo. Si el separador de un paso (ver `SEPARADORES_STREAMING`) no aparece antes
+    de su umbral de caracteres, la generación se cancela con `GeneracionCancelada` y se regenera.
+    """
+
+    def __init__(self, al_fragmento=None, separadores=None):
+        self.al_fragmento = al_fragmento
+        self.separadores = SEPARADORES_STREAMING if separadores is None else separadores
+        self._local = threading.local()
+
+    @contextmanager
+    def item(self, item_id):
+        """Asocia las llamadas del hilo actual al ítem (o lote) `item_id`."""
+        anterior = getattr(self._local, "item", None)
+        self._local.item = item_id
+        try:
+            yield
+        finally:
+            self._local.item = anterior
+
+    def generar(self, model, prompt, paso, **opciones):
+        """Consume la respuesta en streaming; retorna (texto, respuesta con `usage_metadata` y `primer_fragmento`)."""
+        separador, umbral = self.separadores.get(paso, (None, None))
+        separador = separador.upper() if separador else None
+        item_id = getattr(self._local, "item", None)
+        inicio = time.monotonic()
+        respuesta = SimpleNamespace(usage_metadata=None, primer_fragmento=None)
+        texto = ""
+        fragmentos = model.generate_content(prompt, stream=True, **opciones)
+        try:
+            for fragmento in fragmentos:
+                nuevo = texto_fragmento(fragmento)
+                if respuesta.primer_fragmento is None and nuevo:
+                    respuesta.primer_fragmento = time.monotonic() - inicio
+                texto += nuevo
+                respuesta.usage_metadata = getattr(fragmento, "usage_metadata", None) or respuesta.usage_metadata
+                if getattr(fragmento, "nombre_modelo", None):
+                    respuesta.nombre_modelo = fragmento.nombre_modelo
+                if separador is not None:
+                    if separador in texto[-(len(nuevo) + len(separador)):].upper():
+                        separador = None
+                    elif len(texto) > umbral:
+                        raise GeneracionCancelada(
+                            f"Generación cancelada en el {paso}: {len(texto)} caracteres sin el separador "
+                            f"'{self.separadores[paso][0]}'.", texto
+                        )
+                if self.al_fragmento is not None and nuevo:
+                    self.al_fragmento(item_id, paso, texto)
+        finally:
+            cerrar = getattr(fragmentos, "close", None)
+            if cerrar is not None:
+                cerrar()
+        return texto, respuesta
+
+# --- REINTENTOS POR PASO ---
+
+CODIGOS_TRANSITORIOS = {429, 500, 502, 503, 504}
+ERRORES_TRANSITORIOS = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+    "DeadlineExceeded", "RateLimitError", "APITimeoutError", "APIConnectionError",
+}
+
+def es_error_transitorio(e):
+    """Indica si un error de la API (cuota 429, 5xx, red) merece reintentarse."""
+    if isinstance(e, (ConnectionError, TimeoutError)):
+        return True
+    codigo = getattr(e, "code", None) or getattr(e, "status_code", None)
+    try:
+        if int(codigo) in CODIGOS_TRANSITORIOS:
+            return True
+    except (TypeError, ValueError):
+        pass
+    return type(e).__name__ in ERRORES_TRANSITORIOS
+
+class PoliticaReintentos:
+    """Reintentos con espera exponencial y jitter para errores transitorios, y regeneraciones por validación."""
+
+    def __init__(self, max_reintentos=4, espera_base=2.0, espera_maxima=60.0, max_regeneraciones=2):
+        self.max_reintentos = max_reintentos
+        self.espera_base = espera_base
+        self.espera_maxima = espera_maxima
+        self.max_regeneraciones = max_regeneraciones
+
+    def espera(self, intento):
+        """Segundos a esperar antes del reintento número `intento` (desde 0), con jitter."""
+        tope = min(self.espera_maxima, self.espera_base * (2 ** intento))
+        return tope / 2 + random.uniform(0, tope / 2)
+
+POLITICA_REINTENTOS = PoliticaReintentos()
+
+def tokens_de_respuesta(response, prompt, texto):
+    """Tokens de entrada y salida reportados por la API, o estimados si no vienen en la respuesta."""
+    uso = getattr(response, "usage_metadata", None)
+    tokens_entrada = getattr(uso, "prompt_token_count", None) or estimar_tokens(prompt)
+    tokens_salida = getattr(uso, "candidates_token_count", None) or estimar_tokens(texto)
+    return tokens_entrada, tokens_salida
+
+def generar_con_limite(model, prompt, limitador, cache=None, leer_cache=True, validar=None, reintentos=None,
+                       registro=None, paso=None, elementos=1, streaming=None):
+    """Llama a `generate_content` respetando el limitador de tasa y la caché de respuestas.
+
+    Con `leer_cache=False` la caché no se consulta, pero la respuesta nueva sí se guarda.
+    Los errores transitorios se reintentan según `reintentos` (por defecto `POLITICA_REINTENTOS`).
+    Si `validar` rechaza la respuesta con ValueError, solo se regenera esta llamada; las respuestas
+    inválidas nunca se guardan en la caché. Si se pasa un `registro`, la llamada queda en la traza
+    bajo el nombre `paso`.
+
+    Con un `ModelosPorPaso` la llamada usa el cliente y la configuración de generación del nivel de
+    `paso` ("paso2" y "paso2_lote" comparten nivel); `elementos` escala el tope de salida de un lote.
+    Con una `ConfiguracionStreaming` la respuesta se consume por fragmentos y las que pierden la estructura
+    esperada se cancelan y se regeneran sin esperar a que terminen.
+    """
+    reintentos = reintentos or POLITICA_REINTENTOS
+    nivel = paso.removesuffix("_lote") if paso else None
+    generacion, opciones = GENERATION_CONFIG, {}
+    if isinstance(model, ModelosPorPaso):
+        model, generacion = model.para(nivel, elementos)
+        opciones["generation_config"] = generacion
+    modelo = nombre_modelo(model)
+    inicio = time.monotonic()
+    clave = None
+    if cache is not None:
+        clave = CacheRespuestas.clave(prompt, modelo, generacion)
+        if leer_cache:
+            respuesta = cache.obtener(clave)
+            if respuesta is not None and _respuesta_valida(respuesta, validar):
+                if registro is not None:
+                    registro.registrar_llamada(paso, modelo, time.monotonic() - inicio, cache="acierto", nivel=nivel)
+                return respuesta
+
+    metricas = {
+        "espera_limitador": 0.0, "reintentos": 0, "regeneraciones": 0, "cancelaciones": 0, "respuestas": 0,
+        "tokens_entrada": 0, "tokens_salida": 0, "primer_fragmento": None,
+    }
+    error = None
+    modelo_llamada = modelo
+    try:
+        while True:
+            if limitador is not None:
+                inicio_espera = time.monotonic()
+                limitador.adquirir(estimar_tokens(prompt))
+                metricas["espera_limitador"] += time.monotonic() - inicio_espera
+            try:
+                inicio_llamada = time.monotonic()
+                if streaming is not None:
+                    texto, response = streaming.generar(model, prompt, paso, **opciones)
+                    metricas["primer_fragmento"] = response.primer_fragmento
+                else:
+                    response = model.generate_content(prompt, **opciones)
+                    texto = response.text
+                    metricas["primer_fragmento"] = time.monotonic() - inicio_llamada
+                texto = texto.strip()
+            except GeneracionCancelada as e:
+                metricas["cancelaciones"] += 1
+                metricas["respuestas"] += 1
+                metricas["tokens_entrada"] += estimar_tokens(prompt)
+                metricas["tokens_salida"] += estimar_tokens(e.parcial)
+                if metricas["regeneraciones"] < reintentos.max_regeneraciones:
+                    metricas["regeneraciones"] += 1
+                    continue
+                raise
+            except Exception as e:
+                if metricas["reintentos"] < reintentos.max_reintentos and es_error_transitorio(e):
+                    time.sleep(reintentos.espera(metricas["reintentos"]))
+                    metricas["reintentos"] += 1
+                    continue
+                raise
+            tokens_entrada, tokens_salida = tokens_de_respuesta(response, prompt, texto)
+            modelo_llamada = getattr(response, "nombre_modelo", modelo)
+            metricas["respuestas"] += 1
+            metricas["tokens_entrada"] += tokens_entrada
+            metricas["tokens_salida"] += tokens_salida
+            if validar is not None:
+                try:
+                    validar(texto)
+                except ValueError:
+                    if metricas["regeneraciones"] < reintentos.max_regeneraciones:
+                        metricas["regeneraciones"] += 1
+                        continue
+                    raise
+            break
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        if registro is not None:
+            registro.registrar_llamada(
+                paso, modelo_llamada, time.monotonic() - inicio,
+                cache="fallo" if cache is not None and leer_cache else "omitida", error=error, nivel=nivel, **metricas
+            )
+
+    if cache is not None:
+        cache.guardar(clave, texto)
+    return texto
+
+def _respuesta_valida(texto, validar):
+    """Indica si `texto` supera la validación (o si no hay validación)."""
+    if validar is None:
+        return True
+    try:
+        validar(texto)
+        return True
+    except ValueError:
+        return False
+
+def validar_analisis_central(analisis_central):
+    """Verifica el separador del paso 1 y retorna (ruta_cognitiva, analisis_distractores)."""
+    header_correcta = "Ruta Cognitiva Correcta:"
+    header_distractores = "Análisis de Opciones No Válidas:"
+    idx_distractores = analisis_central.find(header_distractores)
+
+    if idx_distractores == -1:
+        raise ValueError("No se encontró el separador 'Análisis de Opciones No Válidas' en la respuesta del paso 1.")
+
+    return analisis_central[len(header_correcta):idx_distractores].strip(), analisis_central[idx_distractores:].strip()
+
+def validar_recomendaciones(recomendaciones):
+    """Verifica el separador del paso 3 y retorna (fortalecer, avanzar)."""
+    titulo_avanzar = "RECOMENDACIÓN PARA AVANZAR"
+    idx_avanzar = recomendaciones.upper().find(titulo_avanzar)
+
+    if idx_avanzar == -1:
+        raise ValueError("No se encontró el separador 'RECOMENDACIÓN PARA AVANZAR' en la respuesta del paso 3.")
+
+    return recomendaciones[:idx_avanzar].strip(), recomendaciones[idx_avanzar:].strip()
+
+def componer_resultado(analisis_central, que_evalua, recomendaciones):
+    """Columnas generadas para una fila a partir de las salidas de los tres pasos."""
+    ruta_cognitiva, analisis_distractores = validar_analisis_central(analisis_central)
+    fortalecer, avanzar = validar_recomendaciones(recomendaciones)
+    return {
+        "Que_Evalua": que_evalua,
+        "Justificacion_Correcta": ruta_cognitiva,
+        "Analisis_Distractores": analisis_distractores,
+        "Recomendacion_Fortalecer": fortalecer,
+        "Recomendacion_Avanzar": avanzar,
+    }
+
+class ErrorPaso(Exception):
+    """Fallo de un paso que conserva las salidas de los pasos anteriores ya completados."""
+
+    def __init__(self, paso, causa, parciales):
+        super().__init__(f"Paso {paso}: {causa}")
+        self.paso = paso
+        self.causa = causa
+        self.parciales = dict(parciales)
+
+def procesar_item(model, fila, limitador=None, cache=None, leer_cache=True, parciales=None, reintentos=None, registro=None,
+                  streaming=None):
+    """Ejecuta en orden los pasos 1→2→3 de un ítem y retorna las columnas generadas.
+
+    Cada paso se reintenta por separado. `parciales` permite reutilizar salidas ya obtenidas
+    (`analisis_central`, `que_evalua`, `recomendaciones`); si un paso falla se lanza `ErrorPaso`
+    con las salidas completadas hasta ese momento.
+    """
+    parciales = dict(parciales or {})
+    paso = 1
+    try:
+        # --- LLAMADA 1: ANÁLISIS CENTRAL (RUTA COGNITIVA Y DISTRACTORES) ---
+        if "analisis_central" not in parciales:
+            prompt_paso1 = construir_prompt_paso1_analisis_central(fila)
+            parciales["analisis_central"] = generar_con_limite(
+                model, prompt_paso1, limitador, cache, leer_cache, validar_analisis_central, reintentos, registro, "paso1",
+                streaming=streaming
+            )
+
+        # --- LLAMADA 2: SÍNTESIS DEL "QUÉ EVALÚA" ---
+        paso = 2
+        if "que_evalua" not in parciales:
+            prompt_paso2 = construir_prompt_paso2_sintesis_que_evalua(parciales["analisis_central"], fila)
+            parciales["que_evalua"] = generar_con_limite(
+                model, prompt_paso2, limitador, cache, leer_cache, None, reintentos, registro, "paso2", streaming=streaming
+            )
+
+        # --- LLAMADA 3: GENERACIÓN DE RECOMENDACIONES ---
+        paso = 3
+        if "recomendaciones" not in parciales:
+            prompt_paso3 = construir_prompt_paso3_recomendaciones(parciales["que_evalua"], parciales["analisis_central"], fila)
+            parciales["recomendaciones"] = generar_con_limite(
+                model, prompt_paso3, limitador, cache, leer_cache, validar_recomendaciones, reintentos, registro, "paso3",
+                streaming=streaming
+            )
+    except Exception as e:
+        raise ErrorPaso(paso, e, parciales) from e
+
+    return componer_resultado(parciales["analisis_central"], parciales["que_evalua"], parciales["recomendaciones"])
+
+def _traza_item(registro, item_id, encolado):
+    """Contexto que mide un ítem en el registro, o uno vacío si no hay registro."""
+    return registro.item(item_id, encolado) if registro is not None else nullcontext()
+
+def _streaming_item(streaming, item_id):
+    """Contexto que asocia las llamadas en streaming al ítem, o uno vacío si no hay streaming."""
+    return streaming.item(item_id) if streaming is not None else nullcontext()
+
+def _procesar_individual(model, i, fila, limitador, cache, leer_cache, parciales=None, reintentos=None, registro=None,
+                         encolado=None, streaming=None):
+    """Procesa un ítem y retorna {i: resultado} o {i: excepción}."""
+    item_id = fila.get('ItemId', i + 1)
+    try:
+        with _traza_item(registro, item_id, encolado), _streaming_item(streaming, item_id):
+            return {i: procesar_item(model, fila, limitador, cache, leer_cache, parciales, reintentos, registro, streaming)}
+    except Exception as e:
+        return {i: e}
+
+# --- MODO POR LOTES (VARIOS ÍTEMS POR SOLICITUD) ---
+
+class EstadisticasLote:
+    """Tokens estimados de los prompts individuales frente a los enviados realmente en modo por lotes."""
+
+    def __init__(self):
+        self.tokens_individuales = 0
+        self.tokens_enviados = 0
+        self.solicitudes_individuales = 0
+        self.solicitudes_enviadas = 0
+        self.elementos_fallback = 0
+        self.lock = threading.Lock()
+
+    def registrar(self, tokens_individuales, tokens_enviados, solicitudes_individuales, solicitudes_enviadas, fallback):
+        with self.lock:
+            self.tokens_individuales += tokens_individuales
+            self.tokens_enviados += tokens_enviados
+            self.solicitudes_individuales += solicitudes_individuales
+            self.solicitudes_enviadas += solicitudes_enviadas
+            self.elementos_fallback += fallback
+
+    def resumen(self):
+        """Retorna los contadores y el ahorro estimado de tokens y solicitudes."""
+        with self.lock:
+            return {
+                "tokens_individuales": self.tokens_individuales,
+                "tokens_enviados": self.tokens_enviados,
+                "tokens_ahorrados": self.tokens_individuales - self.tokens_enviados,
+                "solicitudes_ahorradas": self.solicitudes_individuales - self.solicitudes_enviadas,
+                "elementos_fallback": self.elementos_fallback,
+            }
+
+def _elementos_json(texto):
+    """Objetos JSON de una respuesta de lote; si el arreglo viene truncado, conserva los objetos completos."""
+    inicio, fin = texto.find("["), texto.rfind("]")
+    if inicio != -1 and fin > inicio:
+        try:
+            datos = json.loads(texto[inicio:fin + 1])
+            if isinstance(datos, list):
+                return datos
+        except json.JSONDecodeError:
+            pass
+    decodificador = json.JSONDecoder()
+    elementos = []
+    posicion = max(inicio, 0)
+    while (posicion := texto.find("{", posicion)) != -1:
+        try:
+            elemento, posicion = decodificador.raw_decode(texto, posicion)
+        except json.JSONDecodeError:
+            posicion += 1
+            continue
+        elementos.append(elemento)
+    return elementos
+
+def parsear_respuesta_lote(texto, campo, claves, validar=None):
+    """Extrae de una respuesta JSON los elementos válidos como {ItemId: valor}.
+
+    Cada elemento debe ser un objeto con un "ItemId" esperado y un texto no vacío en `campo` que,
+    si se indica, supere `validar`. Los elementos que no cumplen se omiten para reintentarlos uno a uno;
+    si la respuesta se cortó por el tope de salida, se aprovechan los elementos completos.
+    """
+    datos = _elementos_json(texto)
+
+    validos = {}
+    for elemento in datos:
+        if not isinstance(elemento, dict):
+            continue
+        clave = str(elemento.get("ItemId", "")).strip()
+        valor = elemento.get(campo)
+        if clave not in claves or clave in validos or not isinstance(valor, str) or not valor.strip():
+            continue
+        if validar is not None:
+            try:
+                validar(valor.strip())
+            except ValueError:
+                continue
+        validos[clave] = valor.strip()
+    return validos
+
+def _ejecutar_paso_lote(model, claves, prompt_lote, prompt_individual, campo, validar, limitador, cache, leer_cache, estadisticas,
+                        reintentos=None, registro=None, paso=None, streaming=None):
+    """Ejecuta un paso para varios ítems en una sola solicitud y reintenta uno a uno los elementos inválidos.
+
+    Retorna ({clave: salida}, {clave: excepción}).
+    """
+    if not claves:
+        return {}, {}
+    try:
+        texto = generar_con_limite(
+            model, prompt_lote, limitador, cache, leer_cache, None, reintentos, registro, f"{paso}_lote", elementos=len(claves),
+            streaming=streaming
+        )
+    except Exception:
+        texto = ""
+    validos = parsear_respuesta_lote(texto, campo, set(claves), validar)
+
+    salidas, errores = {}, {}
+    tokens_individuales, tokens_enviados, fallback = 0, estimar_tokens(prompt_lote), 0
+    for clave in claves:
+        prompt = prompt_individual(clave)
+        tokens_individuales += estimar_tokens(prompt)
+        if clave in validos:
+            salidas[clave] = validos[clave]
+            continue
+        fallback += 1
+        tokens_enviados += estimar_tokens(prompt)
+        try:
+            salidas[clave] = generar_con_limite(
+                model, prompt, limitador, cache, leer_cache, validar, reintentos, registro, paso, streaming=streaming
+            )
+        except Exception as e:
+            errores[clave] = e
+    if estadisticas is not None:
+        estadisticas.registrar(tokens_individuales, tokens_enviados, len(claves), 1 + fallback, fallback)
+    return salidas, errores
+
+def _pasos_por_lote(model, claves, limitador, cache, leer_cache, estadisticas, reintentos, registro, streaming=None):
+    """Ejecuta los tres pasos por lotes para {ItemId: (i, fila)} y retorna {i: resultado o ErrorPaso}."""
+    resultados = {}
+    errores = {}
+    activos = list(claves)
+    paso1, fallidos = _ejecutar_paso_lote(
+        model, activos,
+        construir_prompt_lote_paso1([(c, claves[c][1]) for c in activos]),
+        lambda c: construir_prompt_paso1_analisis_central(claves[c][1]),
+        "analisis_central", validar_analisis_central, limitador, cache, leer_cache, estadisticas, reintentos, registro, "paso1",
+        streaming
+    )
+    errores.update(fallidos)
+
+    activos = [c for c in activos if c in paso1]
+    paso2, fallidos = _ejecutar_paso_lote(
+        model, activos,
+        construir_prompt_lote_paso2([(c, paso1[c], claves[c][1]) for c in activos]),
+        lambda c: construir_prompt_paso2_sintesis_que_evalua(paso1[c], claves[c][1]),
+        "que_evalua", None, limitador, cache, leer_cache, estadisticas, reintentos, registro, "paso2",
+        streaming
+    )
+    errores.update(fallidos)
+
+    activos = [c for c in activos if c in paso2]
+    paso3, fallidos = _ejecutar_paso_lote(
+        model, activos,
+        construir_prompt_lote_paso3([(c, paso2[c], paso1[c], claves[c][1]) for c in activos]),
+        lambda c: construir_prompt_paso3_recomendaciones(paso2[c], paso1[c], claves[c][1]),
+        "recomendaciones", validar_recomendaciones, limitador, cache, leer_cache, estadisticas, reintentos, registro, "paso3",
+        streaming
+    )
+    errores.update(fallidos)
+
+    for clave, (i, _) in claves.items():
+        if clave in paso3:
+            resultados[i] = componer_resultado(paso1[clave], paso2[clave], paso3[clave])
+        else:
+            salidas = {"analisis_central": paso1, "que_evalua": paso2}
+            parciales = {campo: valores[clave] for campo, valores in salidas.items() if clave in valores}
+            resultados[i] = ErrorPaso(len(parciales) + 1, errores[clave], parciales)
+    return resultados
+
+def procesar_lote(model, filas, limitador=None, cache=None, leer_cache=True, estadisticas=None, reintentos=None, registro=None,
+                  encolado=None, streaming=None):
+    """Ejecuta los pasos 1→2→3 para varios ítems empaquetando cada paso en una sola solicitud.
+
+    `filas` es una lista de (i, fila). Retorna {i: resultado} o {i: excepción} por fila.
+    """
+    claves = {}
+    repetidas = []
+    for i, fila in filas:
+        clave = str(fila.get('ItemId', i + 1)).strip()
+        if clave in claves:
+            repetidas.append((i, fila))
+        else:
+            claves[clave] = (i, fila)
+
+    try:
+        etiqueta = f"lote[{', '.join(claves)}]"
+        with _traza_item(registro, etiqueta, encolado), _streaming_item(streaming, etiqueta):
+            resultados = _pasos_por_lote(model, claves, limitador, cache, leer_cache, estadisticas, reintentos, registro, streaming)
+    except Exception as e:
+        resultados = {i: e for i, _ in claves.values()}
+
+    for i, fila in repetidas:
+        resultados.update(
+            _procesar_individual(model, i, fila, limitador, cache, leer_cache, None, reintentos, registro, streaming=streaming)
+        )
+    return resultados
+
+def resultado_error(e):
+    """Columnas que se escriben en una fila cuyo procesamiento falló."""
+    return {
+        "Que_Evalua": MARCA_ERROR,
+        "Justificacion_Correcta": f"Error: {e}",
+        "Analisis_Distractores": MARCA_ERROR,
+        "Recomendacion_Fortalecer": MARCA_ERROR,
+        "Recomendacion_Avanzar": MARCA_ERROR,
+    }
+
+def filas_fallidas(df):
+    """Índices de las filas marcadas con "ERROR EN PROCESAMIENTO"."""
+    if "Que_Evalua" not in df.columns:
+        return []
+    return list(df.index[df["Que_Evalua"] == MARCA_ERROR])
+
+# --- PLANIFICACIÓN: DEDUPLICACIÓN DE ÍTEMS REPETIDOS ---
+
+class PlanDeduplicacion:
+    """Agrupa las filas cuyo trabajo es idéntico para ejecutar cada unidad una sola vez y repartir su resultado.
+
+    La huella de una fila es el hash del prompt del paso 1, que incluye todos los campos de la fila que leen
+    también los pasos 2 y 3: dos filas con la misma huella harían exactamente las mismas solicitudes en los
+    tres pasos. El plan vale para una sola ejecución.
+    """
+
+    PASOS = 3
+
+    def __init__(self):
+        self.unidades = {}
+        self.copias = {}
+        self.salidas = {}
+        self.filas_duplicadas = 0
+        self.llamadas_ahorradas = 0
+
+    @staticmethod
+    def huella(fila):
+        """Hash de las entradas de los constructores de prompts de una fila (sin el ItemId)."""
+        return hashlib.sha256(construir_prompt_paso1_analisis_central(fila).encode("utf-8")).hexdigest()
+
+    def planificar(self, filas, tamano_lote=1):
+        """Retorna (filas únicas por despachar, [(j, salida)] de duplicados cuya unidad ya terminó).
+
+        `tamano_lote` es el de los lotes en que se despacharán las filas: el ahorro se cuenta en
+        solicitudes, y con lotes varios duplicados podían ir en una misma solicitud.
+        """
+        unicas, resueltas = [], []
+        duplicadas = self.filas_duplicadas
+        for i, fila in filas:
+            representante = self.unidades.setdefault(self.huella(fila), i)
+            if representante == i:
+                self.copias[i] = []
+                unicas.append((i, fila))
+                continue
+            self.filas_duplicadas += 1
+            if representante in self.salidas:
+                resueltas.append((i, self.salidas[representante]))
+            else:
+                self.copias[representante].append(i)
+        duplicadas = self.filas_duplicadas - duplicadas
+        lotes = math.ceil((len(unicas) + duplicadas) / tamano_lote) - math.ceil(len(unicas) / tamano_lote)
+        self.llamadas_ahorradas += lotes * self.PASOS
+        return unicas, resueltas
+
+    def repartir(self, i, salida):
+        """Guarda la salida de la fila representante `i` y retorna [(j, salida)] para sus duplicados en espera."""
+        if i not in self.copias:
+            return []
+        self.salidas[i] = salida
+        return [(j, salida) for j in self.copias.pop(i)]
+
+    def resumen(self):
+        """Unidades únicas, filas resueltas por duplicado y solicitudes al modelo ahorradas (una por paso y lote)."""
+        return {
+            "unidades_unicas": len(self.unidades),
+            "filas_duplicadas": self.filas_duplicadas,
+            "llamadas_ahorradas": self.llamadas_ahorradas,
+        }
+
+def enriquecer_dataframe(model, df, limitador=None, max_trabajadores=8, al_completar=None, cache=None, leer_cache=True,
+                         checkpoint=None, solo_fallidas=False, al_iniciar=None, tamano_lote=1, estadisticas_lote=None,
+                         reintentos=None, registro=None, deduplicar=True, plan_deduplicacion=None, streaming=None):
+    """Procesa los ítems en paralelo y escribe los resultados en el DataFrame en orden de fila.
+
+    Cada ítem conserva el orden 1→2→3 dentro de su propio hilo. `al_completar(i, item_id, resultado, error)`
+    se invoca desde el hilo que llama a esta función, a medida que terminan los ítems.
+
+    Si se pasa un `checkpoint`, las filas ya registradas se restauran sin volver a procesarse y cada fila
+    terminada se registra de inmediato. Con `solo_fallidas=True` solo se procesan las filas marcadas con error,
+    reutilizando los pasos que ya se habían completado según el checkpoint.
+    `al_iniciar(pendientes, restauradas)` se invoca antes de despachar los ítems.
+
+    Con `tamano_lote > 1` cada paso se envía para varios ítems a la vez (ver `procesar_lote`), hasta
+    `TAMANO_LOTE_MAXIMO`, y el ahorro de tokens se acumula en `estadisticas_lote`. Con un `registro` (RegistroEjecucion) se mide cada ítem,
+    su espera en cola y cada llamada al modelo.
+
+    Con `deduplicar=True` las filas con entradas idénticas se procesan una sola vez y el resultado se copia
+    a las demás (ver `PlanDeduplicacion`); pase un `plan_deduplicacion` para consultar el ahorro.
+    Con `streaming` (ConfiguracionStreaming) las respuestas se consumen por fragmentos (ver `generar_con_limite`).
+    """
+    return enriquecer_por_bloques(
+        model, [df], limitador, max_trabajadores, al_completar, cache, leer_cache, checkpoint, solo_fallidas,
+        al_iniciar, tamano_lote, estadisticas_lote, reintentos, registro, deduplicar, plan_deduplicacion, streaming,
+    )
+
+def enriquecer_por_bloques(model, bloques, limitador=None, max_trabajadores=8, al_completar=None, cache=None, leer_cache=True,
+                           checkpoint=None, solo_fallidas=False, al_iniciar=None, tamano_lote=1, estadisticas_lote=None,
+                           reintentos=None, registro=None, deduplicar=True, plan_deduplicacion=None, streaming=None):
+    """Como `enriquecer_dataframe`, pero recibe los datos como un iterable de DataFrames (ver `leer_excel_por_bloques`).
+
+    Los ítems de cada bloque se despachan en cuanto el bloque llega, así que el primer ítem empieza antes
+    de leer la última fila. Los índices de los bloques deben ser únicos. `al_iniciar(pendientes, restauradas)`
+    se invoca tras cada bloque con los totales acumulados. Retorna el DataFrame completo.
+    """
+    previos = checkpoint.cargar() if checkpoint is not None else {}
+    parciales = checkpoint.cargar_parciales() if checkpoint is not None and solo_fallidas else {}
+    # Un lote mayor que el tope de salida se truncaría y sus ítems se pagarían dos veces.
+    tamano_lote = min(max(1, int(tamano_lote)), TAMANO_LOTE_MAXIMO)
+    if deduplicar and plan_deduplicacion is None:
+        plan_deduplicacion = PlanDeduplicacion()
+    elif not deduplicar:
+        plan_deduplicacion = None
+
+    recibidos = []
+    ids = {}
+    resultados = {}
+    total_pendientes = total_restauradas = 0
+
+    def registrar_salida(i, salida):
+        error = salida if isinstance(salida, Exception) else None
+        resultado = resultado_error(error) if error is not None else salida
+        resultados[i] = resultado
+        if checkpoint is not None:
+            checkpoint.registrar(i, resultado, error is not None, getattr(error, "parciales", None))
+        if al_completar is not None:
+            al_completar(i, ids[i], resultado, error)
+
+    def recoger(futuro):
+        for i, salida in futuro.result().items():
+            registrar_salida(i, salida)
+            if plan_deduplicacion is not None:
+                for j, salida_copia in plan_deduplicacion.repartir(i, salida):
+                    registrar_salida(j, salida_copia)
+
+    en_curso = set()
+    with ThreadPoolExecutor(max_workers=max(1, int(max_trabajadores))) as executor:
+        for df in bloques:
+            recibidos.append(df)
+            for i, resultado in previos.items():
+                if i in df.index:
+                    for col, valor in resultado.items():
+                        df.loc[i, col] = valor
+
+            if solo_fallidas:
+                pendientes = set(filas_fallidas(df))
+            else:
+                pendientes = {i for i in df.index if i not in previos}
+            total_pendientes += len(pendientes)
+            total_restauradas += len(df) - len(pendientes)
+            if al_iniciar is not None:
+                al_iniciar(total_pendientes, total_restauradas)
+
+            filas = [(i, fila) for i, fila in df.iterrows() if i in pendientes and i not in parciales]
+            filas_con_parciales = [(i, fila) for i, fila in df.iterrows() if i in pendientes and i in parciales]
+            for i, fila in df.iterrows():
+                ids[i] = fila.get('ItemId', len(ids) + 1)
+            if plan_deduplicacion is not None:
+                filas, resueltas = plan_deduplicacion.planificar(filas, tamano_lote)
+                for j, salida in resueltas:
+                    registrar_salida(j, salida)
+
+            encolado = time.monotonic()
+            en_curso.update(
+                executor.submit(_procesar_individual, model, i, fila, limitador, cache, leer_cache, parciales[i], reintentos,
+                                registro, encolado, streaming)
+                for i, fila in filas_con_parciales
+            )
+            if tamano_lote == 1:
+                en_curso.update(
+                    executor.submit(_procesar_individual, model, i, fila, limitador, cache, leer_cache, None, reintentos,
+                                    registro, encolado, streaming)
+                    for i, fila in filas
+                )
+            else:
+                en_curso.update(
+                    executor.submit(procesar_lote, model, filas[k:k + tamano_lote], limitador, cache, leer_cache,
+                                    estadisticas_lote, reintentos, registro, encolado, streaming)
+                    for k in range(0, len(filas), tamano_lote)
+                )
+
+            # Mientras se lee el siguiente bloque, se reportan los ítems que ya terminaron.
+            for futuro in [f for f in en_curso if f.done()]:
+                en_curso.discard(futuro)
+                recoger(futuro)
+
+        for futuro in as_completed(en_curso):
+            recoger(futuro)
+
+    if not recibidos:
+        return pd.DataFrame(columns=COLUMNAS_NUEVAS)
+    df = recibidos[0] if len(recibidos) == 1 else pd.concat(recibidos)
+    for i in df.index:
+        if i in resultados:
+            for col, valor in resultados[i].items():
+                df.loc[i, col] = valor
+    return df
+
+
+# --- CARGA, LIMPIEZA Y EXPORTACIÓN ---
+
+def _medir(registro, etapa):
+    """Contexto que mide una etapa en el registro, o uno vacío si no hay registro."""
+    return registro.medir(etapa) if registro is not None else nullcontext()
+
+def limpiar_columna_html(serie):
+    """Quita las etiquetas HTML de una columna completa con operaciones vectorizadas de texto.
+
+    Los valores que no son texto (números, fechas, vacíos) se conservan tal cual.
+    """
+    if pd.api.types.is_string_dtype(serie) and not pd.api.types.is_object_dtype(serie):
+        return serie.str.replace(PATRON_HTML, '', regex=True)
+    es_texto = serie.map(lambda valor: isinstance(valor, str)).astype(bool)
+    if not es_texto.any():
+        return serie
+    limpia = serie.copy()
+    limpia[es_texto] = serie[es_texto].astype(str).str.replace(PATRON_HTML, '', regex=True)
+    return limpia
+
+def limpiar_columnas(df, columnas=None):
+    """Limpia el HTML de las columnas de texto indicadas (todas si `columnas` es None), modificando `df`."""
+    for col in df.columns if columnas is None else [c for c in columnas if c in df.columns]:
+        if pd.api.types.is_object_dtype(df[col]) or pd.api.types.is_string_dtype(df[col]):
+            df[col] = limpiar_columna_html(df[col])
+    return df
+
+def columnas_plantilla(plantilla_bytes):
+    """Variables que usa la plantilla de Word, es decir, las columnas que llegan a las fichas."""
+    return sorted(cargar_plantilla(plantilla_bytes).get_undeclared_template_variables())
+
+def columnas_usadas(plantilla_bytes=None):
+    """Columnas de entrada que leen los prompts y, si se indica, la plantilla (sin las columnas generadas)."""
+    columnas = list(COLUMNAS_PROMPT)
+    if plantilla_bytes is not None:
+        columnas += [c for c in columnas_plantilla(plantilla_bytes) if c not in columnas and c not in COLUMNAS_NUEVAS]
+    return columnas
+
+def _agregar_columnas_nuevas(df):
+    for col in COLUMNAS_NUEVAS:
+        if col not in df.columns:
+            df[col] = ""
+    return df
+
+def preparar_dataframe(fuente_excel, registro=None, columnas=None):
+    """Lee el Excel, limpia el HTML de las columnas de texto y agrega las columnas de resultados.
+
+    Con `columnas` (por ejemplo `columnas_usadas(plantilla_bytes)`) solo se limpian esas columnas.
+    Las columnas se leen como `object` para que cada celda conserve su valor (un entero no pasa a
+    float porque su columna tenga vacíos) y coincida con `leer_excel_por_bloques`.
+    """
+    with _medir(registro, "lectura_excel"):
+        df = pd.read_excel(fuente_excel, dtype=object)
+    with _medir(registro, "limpieza_html"):
+        limpiar_columnas(df, columnas)
+    return _agregar_columnas_nuevas(df)
+
+VACIO = float("nan")
+
+def _valor_celda(valor):
+    """Valor de una celda como lo entrega `pd.read_excel`: vacía como NaN y número entero como int."""
+    if valor is None:
+        return VACIO
+    if isinstance(valor, float) and valor.is_integer():
+        return int(valor)
+    return valor
+
+def _encabezado_excel(celdas):
+    """Nombres de columna como los arma `pd.read_excel`: "Unnamed: k" para las vacías y los repetidos
+    numerados ("X", "X.1", "X.2", ...) saltando los nombres que ya trae el encabezado."""
+    nombres = [c if c is not None else f"Unnamed: {k}" for k, c in enumerate(celdas)]
+    # Como pandas, primero las columnas con nombre y al final las vacías.
+    sin_nombre = [k for k, c in enumerate(celdas) if c is None]
+    usados = {}
+    for k in [k for k in range(len(nombres)) if celdas[k] is not None] + sin_nombre:
+        original = nombre = nombres[k]
+        veces = usados.get(nombre, 0)
+        while veces:
+            usados[original] = veces + 1
+            nombre = f"{original}.{veces}"
+            veces = veces + 1 if nombre in nombres else usados.get(nombre, 0)
+        nombres[k] = nombre
+        usados[nombre] = veces + 1
+    return nombres
+
+def leer_excel_por_bloques(fuente_excel, tamano_bloque=500, registro=None, columnas=None):
+    """Lee la primera hoja del Excel en modo de solo lectura y genera DataFrames de `tamano_bloque` filas ya limpios.
+
+    Cada bloque conserva el índice que tendría la fila con `preparar_dataframe` (los checkpoints son
+    compatibles entre ambos modos) y trae las columnas de resultados. Las filas vacías del final se omiten.
+    """
+    from openpyxl import load_workbook
+
+    libro = load_workbook(fuente_excel, read_only=True, data_only=True)
+    try:
+        filas = libro.worksheets[0].iter_rows(values_only=True)
+        encabezado = next(filas, None)
+        if encabezado is None:
+            return
+        encabezado = _encabezado_excel(encabezado)
+        ancho = len(encabezado)
+        inicio = 0
+        vacias = []
+        while True:
+            with _medir(registro, "lectura_excel"):
+                bloque = list(islice(filas, tamano_bloque))
+            if not bloque:
+                break
+            # Los valores se convierten igual que con `pd.read_excel`, para que los prompts no cambien.
+            bloque = vacias + [
+                tuple(_valor_celda(valor) for valor in fila[:ancho]) + (VACIO,) * (ancho - len(fila))
+                for fila in bloque
+            ]
+            # Las filas vacías al final de un bloque se retienen hasta saber si les sigue alguna con datos.
+            fin = len(bloque)
+            while fin and all(valor is VACIO for valor in bloque[fin - 1]):
+                fin -= 1
+            bloque, vacias = bloque[:fin], bloque[fin:]
+            if not bloque:
+                continue
+            # Con `object` el tipo de cada columna no depende de qué filas cayeron en el bloque.
+            df = pd.DataFrame(bloque, columns=encabezado, index=range(inicio, inicio + len(bloque)), dtype=object)
+            inicio += len(bloque)
+            with _medir(registro, "limpieza_html"):
+                limpiar_columnas(df, columnas)
+            yield _agregar_columnas_nuevas(df)
+    finally:
+        libro.close()
+
+def exportar_excel(df, destino, registro=None):
+    """Escribe el DataFrame enriquecido como .xlsx en `destino` (ruta o archivo binario)."""
+    with _medir(registro, "exportacion_excel"):
+        with pd.ExcelWriter(destino, engine='openpyxl') as writer:
+            df.to_excel(writer, index=False, sheet_name='Datos Enriquecidos')
+
+def _columna_parquet(serie):
+    """Columna `object` con un tipo que Arrow acepte: números como numéricos (enteros con vacíos como
+    Int64, enteros y decimales mezclados como float) y solo el texto realmente mixto como texto."""
+    tipos = set(serie.dropna().map(type))
+    if tipos and all(issubclass(t, numbers.Real) and not issubclass(t, (bool, np.bool_)) for t in tipos):
+        if all(issubclass(t, numbers.Integral) for t in tipos):
+            return serie.astype("Int64")
+        return pd.to_numeric(serie)
+    if len(tipos) > 1:
+        return serie.where(serie.isna(), serie.astype(str))
+    return serie.infer_objects()
+
+def _tabla_parquet(df):
+    """Copia apta para Parquet: nombres de columna como texto y columnas `object` con un tipo definido."""
+    tabla = df.rename(columns=str)
+    for col in tabla.columns:
+        if pd.api.types.is_object_dtype(tabla[col]):
+            tabla[col] = _columna_parquet(tabla[col])
+    return tabla
+
+def exportar_parquet(df, destino):
+    """Escribe el DataFrame en Parquet (requiere pyarrow)."""
+    _tabla_parquet(df).to_parquet(destino, index=False)
+
+def exportar_csv(df, destino):
+    """Escribe el DataFrame como CSV en UTF-8."""
+    df.to_csv(destino, index=False, encoding="utf-8")
+
+def exportar_jsonl(df, destino):
+    """Escribe una línea JSON por fila (los vacíos se escriben como null)."""
+    df.to_json(destino, orient="records", lines=True, force_ascii=False, date_format="iso")
+
+# {formato: (extensión, función que escribe el DataFrame en una ruta)}
+FORMATOS_EXPORTACION = {
+    "xlsx": (".xlsx", exportar_excel),
+    "parquet": (".parquet", exportar_parquet),
+    "csv": (".csv", exportar_csv),
+    "jsonl": (".jsonl", exportar_jsonl),
+}
+VERSION_EXPORTACION = 1
+
+def formatos_disponibles():
+    """Formatos de exportación cuyas dependencias están instaladas (Parquet necesita pyarrow)."""
+    from importlib.util import find_spec
+
+    return [f for f in FORMATOS_EXPORTACION if f != "parquet" or find_spec("pyarrow") is not None]
+
+def validar_formatos(formatos):
+    """Lanza ValueError si algún formato no existe o le falta su dependencia."""
+    desconocidos = [f for f in formatos if f not in FORMATOS_EXPORTACION]
+    if desconocidos:
+        raise ValueError(f"Formato de exportación desconocido: {', '.join(desconocidos)} (use {', '.join(FORMATOS_EXPORTACION)}).")
+    if "parquet" in formatos and "parquet" not in formatos_disponibles():
+        raise ValueError("La exportación a Parquet requiere pyarrow (pip install pyarrow).")
+
+def version_dataframe(df):
+    """Huella SHA-256 de las columnas, los tipos y los valores del DataFrame, en orden de filas."""
+    huella = hashlib.sha256(json.dumps([[str(c), str(t)] for c, t in df.dtypes.items()], ensure_ascii=False).encode("utf-8"))
+    huella.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return huella.hexdigest()
+
+def ruta_exportacion(ruta_base, formato):
+    """Ruta del archivo de un formato: `ruta_base` más la extensión del formato."""
+    return ruta_base + FORMATOS_EXPORTACION[formato][0]
+
+def _manifiesto_exportacion(ruta_base):
+    """Manifiesto de las exportaciones de `ruta_base`, o None si no existe o es de otra versión."""
+    try:
+        with open(ruta_base + ".exportacion.json", encoding="utf-8") as f:
+            manifiesto = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifiesto if manifiesto.get("version") == VERSION_EXPORTACION else None
+
+def _exportacion_vigente(manifiesto, ruta_base, formato, datos):
+    """True si el archivo del formato existe y el manifiesto lo registra con esta versión de los datos."""
+    if manifiesto is None or manifiesto["datos"] != datos or formato not in manifiesto["archivos"]:
+        return False
+    ruta = ruta_exportacion(ruta_base, formato)
+    return os.path.exists(ruta) and os.path.getsize(ruta) == manifiesto["archivos"][formato]
+
+def exportar_formatos(df, ruta_base, formatos=("xlsx",), registro=None, previo=None, datos=None):
+    """Exporta el DataFrame en cada formato como `ruta_base` + extensión; retorna {"datos", "rutas", "reutilizados"}.
+
+    Un manifiesto junto a los archivos registra la versión de los datos (`version_dataframe`): los
+    formatos ya escritos con la misma versión no se vuelven a codificar, y los de otra exportación
+    `previo` (otra ruta base) con los mismos datos se copian en lugar de generarse. `datos` evita
+    recalcular la versión si el llamador ya la tiene.
+    """
+    validar_formatos(formatos)
+    datos = datos or version_dataframe(df)
+    actual = _manifiesto_exportacion(ruta_base)
+    anterior = _manifiesto_exportacion(previo) if previo else None
+    archivos = dict(actual["archivos"]) if actual is not None and actual["datos"] == datos else {}
+    rutas, reutilizados = {}, []
+    for formato in formatos:
+        ruta = rutas[formato] = ruta_exportacion(ruta_base, formato)
+        if _exportacion_vigente(actual, ruta_base, formato, datos):
+            reutilizados.append(formato)
+            continue
+        temporal = ruta_base + ".tmp" + FORMATOS_EXPORTACION[formato][0]
+        if _exportacion_vigente(anterior, previo, formato, datos):
+            shutil.copyfile(ruta_exportacion(previo, formato), temporal)
+            reutilizados.append(formato)
+        else:
+            with _medir(registro, f"exportacion_{formato}" if formato != "xlsx" else "exportacion_excel"):
+                FORMATOS_EXPORTACION[formato][1](df, temporal)
+        os.replace(temporal, ruta)
+        archivos[formato] = os.path.getsize(ruta)
+    with open(ruta_base + ".exportacion.json", "w", encoding="utf-8") as f:
+        json.dump({"version": VERSION_EXPORTACION, "datos": datos, "archivos": archivos}, f)
+    return {"datos": datos, "rutas": rutas, "reutilizados": reutilizados}
+
+# --- ENSAMBLAJE DE FICHAS ---
+
+def nombre_archivo_ficha(fila, columna_nombre_archivo, i):
+    """Nombre del .docx de una fila, sin separadores de ruta."""
+    nombre_base = str(fila.get(columna_nombre_archivo, f"ficha_{i+1}")).replace('/', '_').replace('\\', '_')
+    return f"{nombre_base}.docx"
+
+def contexto_ficha(fila):
+    """Contexto de render de una fila, con los valores vacíos convertidos en cadenas vacías."""
+    contexto = fila.to_dict()
+    return {k: (v if pd.notna(v) else "") for k, v in contexto.items()}
+
+def cargar_plantilla(plantilla_bytes):
+    """Crea el objeto DocxTemplate a partir de los bytes de la plantilla."""
+    from docxtpl import DocxTemplate
+
+    return DocxTemplate(BytesIO(plantilla_bytes))
+
+def renderizar_contexto(doc, contexto):
+    """Renderiza una plantilla ya cargada con un contexto y retorna los bytes del .docx."""
+    doc.render(contexto)
+    doc_buffer = BytesIO()
+    doc.save(doc_buffer)
+    return doc_buffer.getvalue()
+
+class PlantillaFicha:
+    """Plantilla leída una sola vez y renderizada muchas veces.
+
+    `DocxTemplate.render()` vuelve a leer el .docx de la plantilla cada vez que ya se renderizó; aquí
+    se guarda el documento recién leído y cada render parte de una copia en memoria de él.
+    """
+
+    def __init__(self, plantilla_bytes):
+        self.doc = cargar_plantilla(plantilla_bytes)
+        self.doc.init_docx()
+        self.original = self.doc.docx
+
+    def renderizar(self, contexto):
+        """Renderiza un contexto y retorna los bytes del .docx."""
+        self.doc.docx = copy.deepcopy(self.original)
+        self.doc.is_rendered = False
+        return renderizar_contexto(self.doc, contexto)
+
+def _renderizar_medido(plantilla, contexto):
+    """Renderiza una ficha con una `PlantillaFicha` y retorna (bytes, segundos de render)."""
+    inicio = time.monotonic()
+    documento = plantilla.renderizar(contexto)
+    return documento, time.monotonic() - inicio
+
+_plantilla_trabajador = None
+
+def _inicializar_trabajador_fichas(plantilla_bytes):
+    """Lee la plantilla una sola vez en cada proceso trabajador."""
+    global _plantilla_trabajador
+    _plantilla_trabajador = PlantillaFicha(plantilla_bytes)
+
+def _renderizar_lote(contextos):
+    """Renderiza un lote de contextos con la plantilla del proceso trabajador."""
+    return [_renderizar_medido(_plantilla_trabajador, contexto) for contexto in contextos]
+
+def _fichas_renderizadas(contextos, plantilla_bytes, procesos, tamano_lote):
+    """Genera (bytes, segundos de render) de cada ficha en el mismo orden que `contextos`."""
+    if not contextos:
+        return
+    if procesos <= 1:
+        plantilla = PlantillaFicha(plantilla_bytes)
+        for contexto in contextos:
+            yield _renderizar_medido(plantilla, contexto)
+        return
+
+    lotes = [contextos[k:k + tamano_lote] for k in range(0, len(contextos), tamano_lote)]
+    # "spawn" evita heredar por fork los hilos del servidor de Streamlit.
+    with ProcessPoolExecutor(
+        max_workers=min(procesos, len(lotes)),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_inicializar_trabajador_fichas,
+        initargs=(plantilla_bytes,),
+    ) as executor:
+        for documentos in executor.map(_renderizar_lote, lotes):
+            yield from documentos
+
+# Manifiesto de un .zip de fichas: huella de la plantilla y, en el orden del .zip, cada miembro con la
+# huella del contexto de su fila. Se guarda junto al .zip para reutilizar sus fichas en el siguiente ensamblaje.
+VERSION_MANIFIESTO = 1
+
+def huella_contexto(contexto):
+    """Huella SHA-256 del contexto de render de una fila."""
+    return hashlib.sha256(json.dumps(contexto, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+def ruta_manifiesto(ruta_zip):
+    """Ruta del manifiesto que acompaña a un .zip de fichas."""
+    return f"{ruta_zip}.manifiesto.json"
+
+def cargar_manifiesto(ruta_zip):
+    """Manifiesto de un .zip de fichas, o None si no existe o es de otra versión."""
+    try:
+        with open(ruta_manifiesto(ruta_zip), encoding="utf-8") as f:
+            manifiesto = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifiesto if manifiesto.get("version") == VERSION_MANIFIESTO else None
+
+def _fichas_reutilizables(previo, plantilla):
+    """{(nombre, huella): [ZipInfo, ...]} de las fichas de `previo` cuyo manifiesto usa la misma plantilla."""
+    manifiesto = cargar_manifiesto(previo) if previo and os.path.exists(previo) else None
+    if manifiesto is None or manifiesto["plantilla"] != plantilla:
+        return {}
+    with zipfile.ZipFile(previo) as anterior:
+        infos = anterior.infolist()
+    if [info.filename for info in infos] != [nombre for nombre, _ in manifiesto["miembros"]]:
+        return {}
+    reutilizables = {}
+    for (nombre, huella), info in zip(manifiesto["miembros"], infos):
+        reutilizables.setdefault((nombre, huella), []).append(info)
+    return reutilizables
+
+# Detalles internos de `zipfile` (CPython) de los que depende `_copiar_miembro_crudo`.
+INTERNOS_ZIP_ORIGEN = ("fp",)
+INTERNOS_ZIP_DESTINO = ("fp", "_lock", "_writecheck", "_didModify", "start_dir", "_seekable", "filelist", "NameToInfo")
+
+def _admite_copia_cruda(anterior, zip_file):
+    """Indica si esta versión de `zipfile` expone lo que usa `_copiar_miembro_crudo` y el destino admite `seek`.
+
+    Si falta algo (p. ej. tras actualizar Python), el ensamblaje vuelve a `writestr`, que es más lento pero seguro.
+    """
+    return (
+        all(hasattr(anterior, atributo) for atributo in INTERNOS_ZIP_ORIGEN)
+        and all(hasattr(zip_file, atributo) for atributo in INTERNOS_ZIP_DESTINO)
+        and hasattr(zipfile, "sizeFileHeader") and hasattr(zipfile.ZipInfo, "FileHeader")
+        and zip_file._seekable
+    )
+
+def _copiar_miembro_crudo(anterior, info, zip_file):
+    """Copia un miembro de otro .zip con sus bytes comprimidos tal cual, sin descomprimir ni recomprimir.
+
+    `zipfile` no ofrece esta operación: se lee el bloque de datos que sigue a la cabecera local y se escribe
+    con los mismos pasos que `ZipFile.writestr` (cabecera local, datos y entrada del directorio central).
+    """
+    anterior.fp.seek(info.header_offset)
+    cabecera = anterior.fp.read(zipfile.sizeFileHeader)
+    largo_nombre, largo_extra = struct.unpack("<HH", cabecera[26:30])
+    anterior.fp.seek(largo_nombre + largo_extra, os.SEEK_CUR)
+    datos = anterior.fp.read(info.compress_size)
+
+    copia = copy.copy(info)
+    # Sin descriptor de datos: el CRC y los tamaños ya se conocen y van en la cabecera local.
+    copia.flag_bits &= ~0x08
+    with zip_file._lock:
+        zip_file.fp.seek(zip_file.start_dir)
+        copia.header_offset = zip_file.fp.tell()
+        zip_file._writecheck(copia)
+        zip_file._didModify = True
+        zip_file.fp.write(copia.FileHeader())
+        zip_file.fp.write(datos)
+        zip_file.start_dir = zip_file.fp.tell()
+        zip_file.filelist.append(copia)
+        zip_file.NameToInfo[copia.filename] = copia
+
+def ensamblar_fichas(df, plantilla_bytes, columna_nombre_archivo, destino, al_avanzar=None, procesos=1, tamano_lote=16,
+                     compresion=zipfile.ZIP_DEFLATED, registro=None, previo=None):
+    """Genera una ficha por fila y las guarda en un .zip en `destino` (ruta o archivo binario).
+
+    Con `procesos > 1` las fichas se renderizan en un pool de procesos, cada uno con su propia copia
+    de la plantilla, y un único escritor las añade al .zip en el orden de las filas. Cada ficha se escribe
+    en cuanto está lista, así que con una ruta en `destino` el .zip nunca se mantiene completo en memoria.
+    Como las .docx ya están comprimidas, `compresion=zipfile.ZIP_STORED` evita recomprimirlas.
+    `al_avanzar(completadas, total)` se invoca después de añadir cada ficha. Con un `registro` se mide
+    el render de cada ficha y el ensamblaje completo.
+
+    Si `destino` es una ruta, junto al .zip se guarda su manifiesto (ver `ruta_manifiesto`). Con `previo`
+    (ruta de un .zip anterior con manifiesto) solo se renderizan las filas nuevas o modificadas; las fichas
+    con el mismo nombre, la misma plantilla y el mismo contexto se copian de `previo` sin recomprimirlas.
+    El .zip resultante tiene los mismos miembros, en el mismo orden, que un ensamblaje completo.
+    Retorna {"fichas", "renderizadas", "reutilizadas"}.
+    """
+    if columna_nombre_archivo not in df.columns:
+        raise ValueError(f"La columna '{columna_nombre_archivo}' no existe en el Excel. Por favor, elige una de: {', '.join(df.columns)}")
+
+    if previo is not None and isinstance(destino, (str, os.PathLike)) and os.path.abspath(previo) == os.path.abspath(destino):
+        raise ValueError("El .zip anterior no puede ser el mismo archivo de destino.")
+
+    plantilla = hashlib.sha256(plantilla_bytes).hexdigest()
+    reutilizables = _fichas_reutilizables(previo, plantilla)
+    nombres = []
+    huellas = []
+    copias = []
+    contextos = []
+    for i, fila in df.iterrows():
+        nombre = nombre_archivo_ficha(fila, columna_nombre_archivo, i)
+        contexto = contexto_ficha(fila)
+        huella = huella_contexto(contexto)
+        anteriores = reutilizables.get((nombre, huella))
+        nombres.append(nombre)
+        huellas.append(huella)
+        copias.append(anteriores.pop(0) if anteriores else None)
+        if copias[-1] is None:
+            contextos.append(contexto)
+
+    total_docs = len(df)
+    documentos = _fichas_renderizadas(contextos, plantilla_bytes, int(procesos), max(1, int(tamano_lote)))
+    with _medir(registro, "ensamblaje_zip"):
+        with zipfile.ZipFile(destino, "w", compresion, False) as zip_file, \
+                (zipfile.ZipFile(previo) if len(contextos) < total_docs else nullcontext()) as anterior:
+            copia_cruda = anterior is not None and _admite_copia_cruda(anterior, zip_file)
+            for n, (nombre, copia) in enumerate(zip(nombres, copias)):
+                if copia is None:
+                    documento, segundos_render = next(documentos)
+                    zip_file.writestr(nombre, documento)
+                    if registro is not None:
+                        registro.registrar_etapa("render_ficha", segundos_render, nombre)
+                elif copia.compress_type == compresion and copia_cruda:
+                    _copiar_miembro_crudo(anterior, copia, zip_file)
+                else:
+                    # Con otra compresión se reutiliza el documento, pero hay que recomprimirlo.
+                    zip_file.writestr(nombre, anterior.read(copia))
+                if al_avanzar is not None:
+                    al_avanzar(n + 1, total_docs)
+
+    if isinstance(destino, (str, os.PathLike)):
+        with open(ruta_manifiesto(destino), "w", encoding="utf-8") as f:
+            json.dump({"version": VERSION_MANIFIESTO, "plantilla": plantilla, "miembros": list(zip(nombres, huellas))}, f)
+    return {"fichas": total_docs, "renderizadas": len(contextos), "reutilizadas": total_docs - len(contextos)}
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+
+@pytest.fixture(autouse=True)
+def directorios_temporales(tmp_path, monkeypatch):
+    """Caché y checkpoints en una carpeta temporal para no tocar los del repositorio."""
+    import pipeline
+
+    monkeypatch.setattr(pipeline, "RUTA_CACHE", str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(pipeline, "DIRECTORIO_CHECKPOINTS", str(tmp_path / "checkpoints"))
@@ -0,0 +1,169 @@
+import json
+
+import pandas as pd
+import pytest
+
+import pipeline
+from benchmark import filas_sinteticas
+from modelos import ModeloSimulado
+
+
+def _preparado(n):
+    return pipeline._agregar_columnas_nuevas(filas_sinteticas(n))
+
+
+def _limitador():
+    return pipeline.LimitadorTasa(100_000, 100_000_000)
+
+
+class ErrorApi(Exception):
+    def __init__(self, code):
+        super().__init__(f"error {code}")
+        self.code = code
+
+
+class ModeloFallido:
+    """Cliente que siempre falla con el código indicado y cuenta sus llamadas."""
+
+    nombre_modelo = "simulado"
+
+    def __init__(self, code):
+        self.code = code
+        self.llamadas = 0
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        self.llamadas += 1
+        raise ErrorApi(self.code)
+
+
+# --- MODO POR LOTES ---
+
+def test_lote_truncado_conserva_elementos_completos():
+    elementos = [{"ItemId": f"I{k}", "que_evalua": f"texto {k}"} for k in range(5)]
+    texto = "```json\n" + json.dumps(elementos)[:-40]
+
+    validos = pipeline.parsear_respuesta_lote(texto, "que_evalua", {f"I{k}" for k in range(5)})
+
+    assert validos == {f"I{k}": f"texto {k}" for k in range(4)}
+
+
+def test_lote_descarta_elementos_invalidos():
+    texto = json.dumps([
+        {"ItemId": "I0", "que_evalua": "válido"},
+        {"ItemId": "I1", "que_evalua": ""},
+        {"ItemId": "otro", "que_evalua": "fuera del lote"},
+        {"ItemId": "I0", "que_evalua": "repetido"},
+        "no es un objeto",
+    ])
+
+    assert pipeline.parsear_respuesta_lote(texto, "que_evalua", {"I0", "I1"}) == {"I0": "válido"}
+
+
+def test_lote_malformado_se_reintenta_uno_a_uno(monkeypatch):
+    monkeypatch.setattr(ModeloSimulado, "_respuesta_lote", staticmethod(lambda prompt: "[{\"ItemId\": "))
+    estadisticas = pipeline.EstadisticasLote()
+
+    df = pipeline.enriquecer_dataframe(
+        ModeloSimulado(), _preparado(6), _limitador(), tamano_lote=3, estadisticas_lote=estadisticas, deduplicar=False
+    )
+
+    assert not pipeline.filas_fallidas(df)
+    assert estadisticas.elementos_fallback == 6 * 3
+
+
+# --- POOL DE CLIENTES ---
+
+def _pool(*modelos):
+    return pipeline.PoolClientes([
+        pipeline.ClientePool(f"cliente-{n}", model, _limitador()) for n, model in enumerate(modelos, 1)
+    ])
+
+
+@pytest.mark.parametrize("code", [429, 403])
+def test_pool_pasa_al_siguiente_cliente(code):
+    fallido, sano = ModeloFallido(code), ModeloSimulado()
+    pool = _pool(fallido, sano)
+
+    df = pipeline.enriquecer_dataframe(pool, _preparado(8), None, max_trabajadores=1, deduplicar=False)
+
+    assert not pipeline.filas_fallidas(df)
+    estadisticas = {e["cliente"]: e for e in pool.estadisticas()}
+    assert estadisticas["cliente-2"]["solicitudes"] == 8 * 3
+    if code == 403:
+        # Una clave rechazada se deshabilita tras su primera llamada.
+        assert fallido.llamadas == 1 and estadisticas["cliente-1"]["deshabilitado"]
+    else:
+        assert estadisticas["cliente-1"]["errores_cuota"] == fallido.llamadas >= 1
+
+
+def test_pool_ignora_errores_del_contenido():
+    pool = _pool(ModeloFallido(400))
+
+    with pytest.raises(ErrorApi):
+        pool.generate_content("prompt")
+
+    cliente = pool.clientes[0]
+    assert cliente.tasa_error == 0 and cliente.enfriado_hasta == 0
+
+
+def test_pool_propaga_el_error_si_todos_fallan():
+    pool = _pool(ModeloFallido(403), ModeloFallido(403))
+
+    with pytest.raises(ErrorApi):
+        pool.generate_content("prompt")
+    assert all(e["deshabilitado"] for e in pool.estadisticas())
+
+
+# --- CHECKPOINT Y DEDUPLICACIÓN ---
+
+def test_checkpoint_reanuda_sin_repetir_filas(tmp_path):
+    checkpoint = pipeline.CheckpointEnriquecimiento(str(tmp_path / "checkpoint.jsonl"))
+    df = _preparado(10)
+    primero = ModeloSimulado()
+    pipeline.enriquecer_dataframe(primero, df.iloc[:4].copy(), _limitador(), checkpoint=checkpoint, deduplicar=False)
+
+    restauradas = []
+    segundo = ModeloSimulado()
+    reanudado = pipeline.enriquecer_dataframe(
+        segundo, df.copy(), _limitador(), checkpoint=pipeline.CheckpointEnriquecimiento(checkpoint.ruta),
+        al_iniciar=lambda pendientes, previas: restauradas.append(previas), deduplicar=False,
+    )
+
+    assert restauradas == [4]
+    assert segundo.llamadas == 6 * 3
+    assert not pipeline.filas_fallidas(reanudado)
+    assert sorted(pipeline.CheckpointEnriquecimiento(checkpoint.ruta).cargar()) == list(range(10))
+
+
+def test_checkpoint_tolera_linea_truncada(tmp_path):
+    ruta = tmp_path / "checkpoint.jsonl"
+    checkpoint = pipeline.CheckpointEnriquecimiento(str(ruta))
+    checkpoint.registrar(0, {"Que_Evalua": "ok"})
+    with open(ruta, "a", encoding="utf-8") as f:
+        f.write('{"fila": 1, "error": false, "resul')
+
+    reabierto = pipeline.CheckpointEnriquecimiento(str(ruta))
+    reabierto.registrar(2, {"Que_Evalua": "ok"})
+
+    assert sorted(reabierto.cargar()) == [0, 2]
+
+
+@pytest.mark.parametrize("tamano_lote", [1, 4])
+def test_deduplicacion_procesa_cada_unidad_una_vez(tamano_lote):
+    unicos = _preparado(3)
+    df = pd.concat([unicos] * 4, ignore_index=True)
+    df["ItemId"] = [f"COPIA{k}" for k in range(len(df))]
+    model = ModeloSimulado()
+    plan = pipeline.PlanDeduplicacion()
+
+    resultado = pipeline.enriquecer_dataframe(
+        model, df, _limitador(), tamano_lote=tamano_lote, plan_deduplicacion=plan
+    )
+
+    assert not pipeline.filas_fallidas(resultado)
+    assert (resultado["Que_Evalua"] == resultado["Que_Evalua"].iloc[0]).all()
+    resumen = plan.resumen()
+    assert resumen["unidades_unicas"] == 3 and resumen["filas_duplicadas"] == 9
+    # Sin lotes se ahorra una llamada por duplicado y paso; con lotes de 4, los dos lotes que ocupaban.
+    assert resumen["llamadas_ahorradas"] == (27 if tamano_lote == 1 else 6)
+    assert model.llamadas == (9 if tamano_lote == 1 else 3)
@@ -0,0 +1,75 @@
+import zipfile
+
+import pytest
+
+import pipeline
+from benchmark import filas_sinteticas, plantilla_sintetica
+
+
+@pytest.fixture(scope="module")
+def plantilla():
+    return plantilla_sintetica()
+
+
+def _datos(n=12):
+    df = filas_sinteticas(n)
+    for col in pipeline.COLUMNAS_NUEVAS:
+        df[col] = f"texto de {col}"
+    return df
+
+
+def _miembros(ruta):
+    with zipfile.ZipFile(ruta) as archivo:
+        assert archivo.testzip() is None
+        return [(info.filename, archivo.read(info)) for info in archivo.infolist()]
+
+
+def _modificado(df):
+    modificado = df.copy()
+    modificado.loc[3, "ItemEnunciado"] = "Enunciado corregido"
+    modificado.loc[7, "Que_Evalua"] = "Otro texto"
+    return modificado.drop(index=5).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("compresion", [zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED])
+def test_ensamblaje_incremental_igual_a_completo(tmp_path, plantilla, compresion, monkeypatch):
+    copiar = pipeline._copiar_miembro_crudo
+    copiados = []
+    monkeypatch.setattr(pipeline, "_copiar_miembro_crudo", lambda *args: copiados.append(args) or copiar(*args))
+    df = _datos()
+    previo = tmp_path / "previo.zip"
+    pipeline.ensamblar_fichas(df, plantilla, "ItemId", str(previo), compresion=compresion)
+
+    modificado = _modificado(df)
+    completo = tmp_path / "completo.zip"
+    incremental = tmp_path / "incremental.zip"
+    pipeline.ensamblar_fichas(modificado, plantilla, "ItemId", str(completo), compresion=compresion)
+    conteo = pipeline.ensamblar_fichas(
+        modificado, plantilla, "ItemId", str(incremental), compresion=compresion, previo=str(previo)
+    )
+
+    assert conteo["renderizadas"] == 2
+    assert conteo["reutilizadas"] == len(copiados) == len(modificado) - 2
+    assert [nombre for nombre, _ in _miembros(incremental)] == [nombre for nombre, _ in _miembros(completo)]
+    # Las fichas reutilizadas son las del .zip anterior, byte a byte.
+    anteriores = dict(_miembros(previo))
+    for nombre, datos in _miembros(incremental):
+        if nombre not in ("ITEM000003.docx", "ITEM000007.docx"):
+            assert datos == anteriores[nombre]
+
+
+def test_ensamblaje_incremental_sin_copia_cruda(tmp_path, plantilla, monkeypatch):
+    df = _datos()
+    previo = tmp_path / "previo.zip"
+    pipeline.ensamblar_fichas(df, plantilla, "ItemId", str(previo))
+
+    copiados = []
+    monkeypatch.setattr(pipeline, "_admite_copia_cruda", lambda anterior, zip_file: False)
+    monkeypatch.setattr(pipeline, "_copiar_miembro_crudo", lambda *args: copiados.append(args))
+    incremental = tmp_path / "incremental.zip"
+    conteo = pipeline.ensamblar_fichas(_modificado(df), plantilla, "ItemId", str(incremental), previo=str(previo))
+
+    assert not copiados
+    assert conteo["reutilizadas"] == len(df) - 3
+    anteriores = dict(_miembros(previo))
+    assert dict(_miembros(incremental))["ITEM000000.docx"] == anteriores["ITEM000000.docx"]
@@ -0,0 +1,41 @@
+import pandas as pd
+from openpyxl import Workbook
+
+from pipeline import leer_excel_por_bloques, preparar_dataframe
+
+
+def _libro(ruta, encabezado, filas):
+    libro = Workbook()
+    hoja = libro.active
+    hoja.append(encabezado)
+    for fila in filas:
+        hoja.append(fila)
+    libro.save(ruta)
+    return ruta
+
+
+def _por_bloques(ruta, tamano_bloque):
+    return pd.concat(list(leer_excel_por_bloques(ruta, tamano_bloque=tamano_bloque)))
+
+
+def test_encabezados_repetidos_como_read_excel(tmp_path):
+    encabezado = ["Nombre", "Nombre", "Nombre.1", None, "Nombre", "Puntaje"]
+    filas = [[f"n{i}", f"a{i}", f"b{i}", i, f"c{i}", i * 1.5] for i in range(7)]
+    ruta = _libro(tmp_path / "repetidos.xlsx", encabezado, filas)
+
+    completo = preparar_dataframe(ruta)
+    por_bloques = _por_bloques(ruta, tamano_bloque=3)
+
+    assert list(por_bloques.columns) == list(completo.columns)
+    pd.testing.assert_frame_equal(por_bloques, completo)
+
+
+def test_bloques_conservan_valores_e_indices(tmp_path):
+    filas = [[i, valor, f"<p>texto {i}</p>"] for i, valor in enumerate([3, None, 5, 7.5, 9])]
+    ruta = _libro(tmp_path / "valores.xlsx", ["ItemId", "Grado", "Descripcion"], filas + [[None, None, None]])
+
+    completo = preparar_dataframe(ruta)
+    por_bloques = _por_bloques(ruta, tamano_bloque=2)
+
+    assert list(por_bloques.index) == list(range(5))
+    pd.testing.assert_frame_equal(por_bloques, completo)
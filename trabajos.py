@@ -0,0 +1,701 @@
+# -*- coding: utf-8 -*-
+"""Trabajos en segundo plano (enriquecimiento y ensamblaje) con una cola local en SQLite.
+
+La interfaz solo encola trabajos, consulta su estado y descarga sus artefactos por id. Un proceso
+trabajador independiente (`python trabajos.py`) los ejecuta, así que cerrar la pestaña, recargar la página
+o que dos personas lancen trabajos a la vez no interrumpe el procesamiento.
+
+Cada trabajo tiene una carpeta en `DIRECTORIO_TRABAJOS/<id>/` con sus archivos de entrada y sus artefactos;
+el trabajador borra los trabajos terminados hace más de `DIAS_RETENCION` días.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pipeline
+from instrumentacion import RegistroEjecucion
+
+DIRECTORIO_TRABAJOS = os.environ.get("DIRECTORIO_TRABAJOS", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".trabajos"))
+
+EN_COLA = "en_cola"
+EN_CURSO = "en_curso"
+COMPLETADO = "completado"
+FALLIDO = "fallido"
+ESTADOS_FINALES = (COMPLETADO, FALLIDO)
+
+ENRIQUECIMIENTO = "enriquecimiento"
+ENSAMBLAJE = "ensamblaje"
+
+# Segundos sin latido tras los que se considera que el trabajador ya no está activo.
+LATIDO_MAXIMO = 15.0
+# Líneas recientes de la bitácora que se conservan por trabajo.
+LINEAS_BITACORA = 50
+# Textos parciales en streaming que se publican (los más recientes), su largo máximo y su vigencia en segundos.
+MAX_PARCIALES = 4
+LARGO_PARCIAL = 1500
+VIGENCIA_PARCIAL = 30.0
+# Días que se conservan los trabajos terminados (carpeta y registro) antes de purgarlos; 0 = sin límite.
+DIAS_RETENCION = float(os.environ.get("DIAS_RETENCION_TRABAJOS", 7))
+# Segundos entre purgas mientras el trabajador está activo.
+INTERVALO_PURGA = 3600.0
+# Checkpoint propio de cada trabajo de enriquecimiento, dentro de su carpeta.
+ARCHIVO_CHECKPOINT = "checkpoint.jsonl"
+# Archivo con las claves API de un trabajo dentro de su carpeta (solo legible por el usuario del proceso).
+ARCHIVO_SECRETO = "secreto.json"
+
+# --- COLA EN SQLITE ---
+
+class ColaTrabajos:
+    """Cola de trabajos compartida entre la interfaz y el proceso trabajador.
+
+    Guarda estado, progreso, parámetros, artefactos y resumen de cada trabajo. Las claves API no se
+    guardan en la base de datos (ni, por tanto, en su WAL): van en `ARCHIVO_SECRETO` dentro de la
+    carpeta del trabajo, con permisos 0600, y se borran en cuanto el trabajo termina.
+    """
+
+    def __init__(self, directorio=DIRECTORIO_TRABAJOS):
+        os.makedirs(directorio, exist_ok=True)
+        self.directorio_base = directorio
+        self.lock = threading.Lock()
+        # Sin transacciones implícitas: cada sentencia se confirma sola y `tomar` abre la suya.
+        self.conexion = sqlite3.connect(
+            os.path.join(directorio, "cola.sqlite"), timeout=30, check_same_thread=False, isolation_level=None
+        )
+        self.conexion.execute("PRAGMA journal_mode=WAL")
+        self.conexion.execute(
+            "CREATE TABLE IF NOT EXISTS trabajos ("
+            "id TEXT PRIMARY KEY, tipo TEXT NOT NULL, estado TEXT NOT NULL, parametros TEXT NOT NULL, "
+            "completados INTEGER NOT NULL DEFAULT 0, total INTEGER NOT NULL DEFAULT 0, mensaje TEXT, error TEXT, "
+            "artefactos TEXT, resumen TEXT, creado REAL NOT NULL, iniciado REAL, terminado REAL, "
+            "errores INTEGER NOT NULL DEFAULT 0, bitacora TEXT, parciales TEXT)"
+        )
+        self.conexion.execute(
+            "CREATE TABLE IF NOT EXISTS items_trabajo ("
+            "trabajo_id TEXT NOT NULL, fila INTEGER NOT NULL, item_id TEXT, estado TEXT NOT NULL, error TEXT, "
+            "terminado REAL NOT NULL, PRIMARY KEY (trabajo_id, fila))"
+        )
+        self.conexion.execute(
+            "CREATE TABLE IF NOT EXISTS trabajador ("
+            "id INTEGER PRIMARY KEY CHECK (id = 1), pid INTEGER, latido REAL, max_paralelos INTEGER NOT NULL DEFAULT 2)"
+        )
+        self.conexion.execute("INSERT OR IGNORE INTO trabajador (id, pid, latido) VALUES (1, NULL, 0)")
+
+    def directorio(self, trabajo_id):
+        """Carpeta con los archivos de entrada y los artefactos de un trabajo."""
+        return os.path.join(self.directorio_base, trabajo_id)
+
+    def ruta_artefacto(self, trabajo, nombre):
+        """Ruta absoluta del artefacto `nombre` de un trabajo, o None si no lo tiene."""
+        archivo = (trabajo.get("artefactos") or {}).get(nombre)
+        return os.path.join(self.directorio(trabajo["id"]), archivo) if archivo else None
+
+    def encolar(self, tipo, parametros, archivos=None, secreto=None):
+        """Crea un trabajo con sus archivos de entrada ({nombre: bytes}) y retorna su id."""
+        trabajo_id = uuid.uuid4().hex[:12]
+        os.makedirs(self.directorio(trabajo_id))
+        for nombre, contenido in (archivos or {}).items():
+            with open(os.path.join(self.directorio(trabajo_id), nombre), "wb") as f:
+                f.write(contenido)
+        if secreto is not None:
+            descriptor = os.open(
+                os.path.join(self.directorio(trabajo_id), ARCHIVO_SECRETO), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600
+            )
+            with os.fdopen(descriptor, "w", encoding="utf-8") as f:
+                f.write(secreto)
+        with self.lock:
+            self.conexion.execute(
+                "INSERT INTO trabajos (id, tipo, estado, parametros, creado) VALUES (?, ?, ?, ?, ?)",
+                (trabajo_id, tipo, EN_COLA, json.dumps(parametros), time.time())
+            )
+        return trabajo_id
+
+    def borrar_secreto(self, trabajo_id):
+        """Elimina las claves API guardadas para un trabajo, si las hay."""
+        try:
+            os.remove(os.path.join(self.directorio(trabajo_id), ARCHIVO_SECRETO))
+        except FileNotFoundError:
+            pass
+
+    def tomar(self):
+        """Marca como en curso el trabajo en cola más antiguo y lo retorna (con su secreto), o None."""
+        with self.lock:
+            self.conexion.execute("BEGIN IMMEDIATE")
+            try:
+                fila = self.conexion.execute(
+                    "SELECT id FROM trabajos WHERE estado = ? ORDER BY creado LIMIT 1", (EN_COLA,)
+                ).fetchone()
+                if fila is not None:
+                    self.conexion.execute(
+                        "UPDATE trabajos SET estado = ?, iniciado = ? WHERE id = ?", (EN_CURSO, time.time(), fila[0])
+                    )
+                self.conexion.execute("COMMIT")
+            except Exception:
+                self.conexion.execute("ROLLBACK")
+                raise
+        return self.obtener(fila[0], con_secreto=True) if fila is not None else None
+
+    def progreso(self, trabajo_id, completados, total, mensaje=None, resumen=None, errores=0, bitacora=None, items=(),
+                 parciales=None):
+        """Actualiza el avance de un trabajo en curso.
+
+        `bitacora` reemplaza las últimas líneas guardadas, `items` son tuplas (fila, item_id, estado, error, terminado)
+        que se añaden al detalle por ítem y `resumen`, si se indica, reemplaza el resumen parcial.
+        `parciales` reemplaza los textos en streaming de los ítems en curso.
+        """
+        with self.lock:
+            self.conexion.execute("BEGIN IMMEDIATE")
+            try:
+                self.conexion.execute(
+                    "UPDATE trabajos SET completados = ?, total = ?, errores = ?, mensaje = COALESCE(?, mensaje), "
+                    "resumen = COALESCE(?, resumen), bitacora = COALESCE(?, bitacora), parciales = COALESCE(?, parciales) "
+                    "WHERE id = ?",
+                    (completados, total, errores, mensaje, json.dumps(resumen, default=str) if resumen is not None else None,
+                     json.dumps(bitacora) if bitacora is not None else None,
+                     json.dumps(parciales) if parciales is not None else None, trabajo_id)
+                )
+                self.conexion.executemany(
+                    "INSERT OR REPLACE INTO items_trabajo (trabajo_id, fila, item_id, estado, error, terminado) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(trabajo_id,) + tuple(item) for item in items]
+                )
+                self.conexion.execute("COMMIT")
+            except Exception:
+                self.conexion.execute("ROLLBACK")
+                raise
+
+    def items(self, trabajo_id, estado=None, texto=None, limite=1000):
+        """Detalle por ítem de un trabajo, filtrado por estado y por texto en el id o el error."""
+        consulta = "SELECT fila, item_id, estado, error, terminado FROM items_trabajo WHERE trabajo_id = ?"
+        argumentos = [trabajo_id]
+        if estado:
+            consulta += " AND estado = ?"
+            argumentos.append(estado)
+        if texto:
+            consulta += " AND (item_id LIKE ? OR error LIKE ?)"
+            argumentos += [f"%{texto}%"] * 2
+        consulta += " ORDER BY fila LIMIT ?"
+        argumentos.append(limite)
+        with self.lock:
+            cursor = self.conexion.execute(consulta, argumentos)
+            columnas = [c[0] for c in cursor.description]
+            return [dict(zip(columnas, fila)) for fila in cursor.fetchall()]
+
+    def completar(self, trabajo_id, artefactos, resumen):
+        """Marca el trabajo como completado con sus artefactos ({nombre: archivo en su carpeta})."""
+        with self.lock:
+            self.conexion.execute(
+                "UPDATE trabajos SET estado = ?, artefactos = ?, resumen = ?, parciales = NULL, "
+                "terminado = ?, mensaje = 'Completado' WHERE id = ?",
+                (COMPLETADO, json.dumps(artefactos), json.dumps(resumen, default=str), time.time(), trabajo_id)
+            )
+        self.borrar_secreto(trabajo_id)
+
+    def fallar(self, trabajo_id, error):
+        """Marca el trabajo como fallido con el mensaje de error."""
+        with self.lock:
+            self.conexion.execute(
+                "UPDATE trabajos SET estado = ?, error = ?, parciales = NULL, terminado = ? WHERE id = ?",
+                (FALLIDO, error, time.time(), trabajo_id)
+            )
+        self.borrar_secreto(trabajo_id)
+
+    def reencolar_interrumpidos(self):
+        """Devuelve a la cola los trabajos que quedaron en curso (el trabajador se detuvo a medias).
+
+        El enriquecimiento continúa desde su checkpoint, así que no se repiten las filas ya procesadas.
+        """
+        with self.lock:
+            return self.conexion.execute(
+                "UPDATE trabajos SET estado = ?, iniciado = NULL WHERE estado = ?", (EN_COLA, EN_CURSO)
+            ).rowcount
+
+    def _huellas_pendientes(self, tipo, archivo):
+        """sha256 de `archivo` en la carpeta de cada trabajo de `tipo` que aún no terminó."""
+        with self.lock:
+            pendientes = [f[0] for f in self.conexion.execute(
+                "SELECT id FROM trabajos WHERE tipo = ? AND estado NOT IN (?, ?)", (tipo, *ESTADOS_FINALES)
+            )]
+        huellas = set()
+        for trabajo_id in pendientes:
+            try:
+                with open(os.path.join(self.directorio(trabajo_id), archivo), "rb") as f:
+                    huellas.add(hashlib.sha256(f.read()).hexdigest())
+            except FileNotFoundError:
+                pass
+        return huellas
+
+    def purgar(self, dias=DIAS_RETENCION, directorio_checkpoints=None):
+        """Borra los trabajos terminados hace más de `dias` días (registro, detalle y carpeta); retorna cuántos.
+
+        Se conservan los enriquecimientos que un trabajo pendiente usa como origen y los ensamblajes con la
+        misma plantilla que un ensamblaje pendiente (puede reutilizar su .zip como `previo`). También se
+        borran las carpetas igual de antiguas que no tienen registro (un encolado interrumpido) y los
+        checkpoints por libro sin usar en ese plazo, salvo los de enriquecimientos pendientes.
+        """
+        if dias <= 0:
+            return 0
+        limite = time.time() - dias * 86400
+        plantillas = self._huellas_pendientes(ENSAMBLAJE, "plantilla.docx")
+        libros = self._huellas_pendientes(ENRIQUECIMIENTO, "entrada.xlsx")
+        with self.lock:
+            vencidos = [(f[0], f[1], json.loads(f[2]) if f[2] else {}) for f in self.conexion.execute(
+                "SELECT id, tipo, resumen FROM trabajos WHERE estado IN (?, ?) AND terminado < ?",
+                (*ESTADOS_FINALES, limite)
+            )]
+            origenes = {
+                json.loads(f[0]).get("origen") for f in self.conexion.execute(
+                    "SELECT parametros FROM trabajos WHERE estado NOT IN (?, ?)", ESTADOS_FINALES
+                )
+            }
+            vencidos = [
+                trabajo_id for trabajo_id, tipo, resumen in vencidos
+                if trabajo_id not in origenes and not (tipo == ENSAMBLAJE and resumen.get("plantilla") in plantillas)
+            ]
+            for trabajo_id in vencidos:
+                self.conexion.execute("DELETE FROM items_trabajo WHERE trabajo_id = ?", (trabajo_id,))
+                self.conexion.execute("DELETE FROM trabajos WHERE id = ?", (trabajo_id,))
+            registrados = {f[0] for f in self.conexion.execute("SELECT id FROM trabajos")}
+        for trabajo_id in vencidos:
+            shutil.rmtree(self.directorio(trabajo_id), ignore_errors=True)
+        for nombre in os.listdir(self.directorio_base):
+            ruta = self.directorio(nombre)
+            if nombre not in registrados and os.path.isdir(ruta) and os.path.getmtime(ruta) < limite:
+                shutil.rmtree(ruta, ignore_errors=True)
+        # Los checkpoints por libro se nombran con la huella del Excel (`CheckpointEnriquecimiento.para_libro`).
+        directorio_checkpoints = directorio_checkpoints or pipeline.DIRECTORIO_CHECKPOINTS
+        if os.path.isdir(directorio_checkpoints):
+            for nombre in os.listdir(directorio_checkpoints):
+                ruta = os.path.join(directorio_checkpoints, nombre)
+                try:
+                    if nombre.split(".")[0] not in libros and os.path.isfile(ruta) and os.path.getmtime(ruta) < limite:
+                        os.remove(ruta)
+                except FileNotFoundError:
+                    pass
+        return len(vencidos)
+
+    def obtener(self, trabajo_id, con_secreto=False):
+        """Retorna el trabajo como diccionario, o None si no existe."""
+        with self.lock:
+            cursor = self.conexion.execute("SELECT * FROM trabajos WHERE id = ?", (trabajo_id,))
+            fila = cursor.fetchone()
+            columnas = [c[0] for c in cursor.description]
+        if fila is None:
+            return None
+        trabajo = dict(zip(columnas, fila))
+        for campo in ("parametros", "artefactos", "resumen", "bitacora", "parciales"):
+            trabajo[campo] = json.loads(trabajo[campo]) if trabajo[campo] else None
+        if con_secreto:
+            try:
+                with open(os.path.join(self.directorio(trabajo_id), ARCHIVO_SECRETO), encoding="utf-8") as f:
+                    trabajo["secreto"] = f.read()
+            except FileNotFoundError:
+                trabajo["secreto"] = None
+        return trabajo
+
+    def listar(self, limite=20):
+        """Trabajos más recientes primero (sin secretos)."""
+        with self.lock:
+            ids = [f[0] for f in self.conexion.execute("SELECT id FROM trabajos ORDER BY creado DESC LIMIT ?", (limite,))]
+        return [self.obtener(trabajo_id) for trabajo_id in ids]
+
+    # --- Registro del proceso trabajador ---
+
+    def registrar_trabajador(self, pid):
+        """Reclama el puesto de trabajador para `pid`; False si ya hay otro activo."""
+        with self.lock:
+            self.conexion.execute("BEGIN IMMEDIATE")
+            try:
+                otro, latido = self.conexion.execute("SELECT pid, latido FROM trabajador WHERE id = 1").fetchone()
+                libre = otro in (None, pid) or time.time() - latido > LATIDO_MAXIMO
+                if libre:
+                    self.conexion.execute("UPDATE trabajador SET pid = ?, latido = ? WHERE id = 1", (pid, time.time()))
+                self.conexion.execute("COMMIT")
+            except Exception:
+                self.conexion.execute("ROLLBACK")
+                raise
+        return libre
+
+    def latido(self, pid):
+        """Renueva el latido del trabajador y retorna el límite de trabajos en paralelo vigente."""
+        with self.lock:
+            self.conexion.execute("UPDATE trabajador SET latido = ? WHERE id = 1 AND pid = ?", (time.time(), pid))
+            return self.conexion.execute("SELECT max_paralelos FROM trabajador WHERE id = 1").fetchone()[0]
+
+    def liberar_trabajador(self, pid):
+        """Deja libre el puesto de trabajador al terminar el proceso `pid`."""
+        with self.lock:
+            self.conexion.execute("UPDATE trabajador SET pid = NULL WHERE id = 1 AND pid = ?", (pid,))
+
+    def max_paralelos(self):
+        """Número máximo de trabajos en paralelo configurado."""
+        with self.lock:
+            return self.conexion.execute("SELECT max_paralelos FROM trabajador WHERE id = 1").fetchone()[0]
+
+    def configurar(self, max_paralelos):
+        """Cambia el número máximo de trabajos en paralelo; el trabajador lo aplica en su siguiente latido."""
+        with self.lock:
+            self.conexion.execute("UPDATE trabajador SET max_paralelos = ? WHERE id = 1", (max(1, int(max_paralelos)),))
+
+    def trabajador_activo(self):
+        """Indica si algún proceso trabajador dio señales de vida recientemente."""
+        with self.lock:
+            pid, latido = self.conexion.execute("SELECT pid, latido FROM trabajador WHERE id = 1").fetchone()
+        return pid is not None and time.time() - latido <= LATIDO_MAXIMO
+
+
+def asegurar_trabajador(cola):
+    """Lanza el proceso trabajador en segundo plano si no hay uno activo; retorna True si lo lanzó.
+
+    El proceso queda desacoplado de la sesión (sobrevive a recargas y al cierre de la pestaña) y escribe
+    su salida en `trabajador.log` dentro de la carpeta de trabajos.
+    """
+    if cola.trabajador_activo():
+        return False
+    with open(os.path.join(cola.directorio_base, "trabajador.log"), "ab") as log:
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--directorio", cola.directorio_base],
+            stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+            start_new_session=True, close_fds=True,
+        )
+    return True
+
+# --- EJECUCIÓN DE LOS TRABAJOS ---
+
+class ReportadorProgreso:
+    """Acumula el avance de un trabajo y lo escribe en la cola como máximo cada `intervalo` segundos.
+
+    Guarda las últimas `LINEAS_BITACORA` líneas de la bitácora y el resultado de cada ítem para el
+    detalle bajo demanda; las métricas del registro (y los aciertos de `cache`, si se indica) se
+    recalculan cada `intervalo_metricas` segundos.
+    `fragmento` se llama desde los hilos de trabajo con el texto en streaming de los ítems en curso.
+    """
+
+    def __init__(self, cola, trabajo_id, registro=None, intervalo=0.5, intervalo_metricas=5.0, cache=None):
+        self.cola = cola
+        self.trabajo_id = trabajo_id
+        self.registro = registro
+        self.cache = cache
+        self.intervalo = intervalo
+        self.intervalo_metricas = intervalo_metricas
+        self.ultimo = 0.0
+        self.ultimas_metricas = 0.0
+        self.completados = 0
+        self.total = 0
+        self.errores = 0
+        self.mensaje = None
+        self.bitacora = deque(maxlen=LINEAS_BITACORA)
+        self.items_pendientes = []
+        self.parciales = {}
+        self.parciales_cambiaron = False
+        self.lock = threading.RLock()
+
+    def anotar(self, linea):
+        """Añade una línea con la hora a la bitácora."""
+        self.bitacora.append(f"{time.strftime('%H:%M:%S')} {linea}")
+
+    def item(self, i, item_id, error=None):
+        """Registra un ítem terminado (con su error, si lo hubo) y actualiza el avance."""
+        with self.lock:
+            self.completados += 1
+            if error is None:
+                self.anotar(f"✅ Ítem {item_id}")
+            else:
+                self.errores += 1
+                self.anotar(f"❌ Ítem {item_id}: {str(error)[:200]}")
+            self.items_pendientes.append(
+                (int(i), str(item_id), "ok" if error is None else "error", None if error is None else str(error), time.time())
+            )
+            self.parciales_cambiaron |= self.parciales.pop(str(item_id), None) is not None
+            self.actualizar()
+
+    def fragmento(self, item_id, paso, texto):
+        """Guarda el final del texto que genera un ítem en streaming y lo publica con el próximo avance."""
+        with self.lock:
+            self.parciales[str(item_id)] = (time.monotonic(), paso, texto[-LARGO_PARCIAL:])
+            self.parciales_cambiaron = True
+            self.actualizar()
+
+    def _parciales_vigentes(self):
+        """Textos parciales más recientes, como lista de {"item", "paso", "texto"}; descarta los antiguos."""
+        limite = time.monotonic() - VIGENCIA_PARCIAL
+        for item_id in [k for k, (momento, _, _) in self.parciales.items() if momento < limite]:
+            del self.parciales[item_id]
+        recientes = sorted(self.parciales.items(), key=lambda par: par[1][0], reverse=True)[:MAX_PARCIALES]
+        return [{"item": item_id, "paso": paso, "texto": texto} for item_id, (_, paso, texto) in recientes]
+
+    def actualizar(self, completados=None, total=None, mensaje=None, forzar=False):
+        with self.lock:
+            self._actualizar(completados, total, mensaje, forzar)
+
+    def _actualizar(self, completados, total, mensaje, forzar):
+        if completados is not None:
+            self.completados = completados
+        if total is not None:
+            self.total = total
+        nuevo_mensaje = mensaje is not None and mensaje != self.mensaje
+        if nuevo_mensaje:
+            self.mensaje = mensaje
+            self.anotar(mensaje)
+        ahora = time.monotonic()
+        terminado = self.total and self.completados >= self.total
+        if forzar or nuevo_mensaje or terminado or ahora - self.ultimo >= self.intervalo:
+            self.ultimo = ahora
+            resumen = None
+            if self.registro is not None and (forzar or terminado or ahora - self.ultimas_metricas >= self.intervalo_metricas):
+                self.ultimas_metricas = ahora
+                resumen = {"metricas": self.registro.resumen()}
+                if self.cache is not None:
+                    resumen["cache"] = {"aciertos": self.cache.aciertos, "fallos": self.cache.fallos}
+            items, self.items_pendientes = self.items_pendientes, []
+            parciales = self._parciales_vigentes() if self.parciales_cambiaron else None
+            self.parciales_cambiaron = False
+            self.cola.progreso(
+                self.trabajo_id, self.completados, self.total, mensaje if nuevo_mensaje else None, resumen,
+                self.errores, list(self.bitacora), items, parciales,
+            )
+
+
+def ejecutar_enriquecimiento(cola, trabajo):
+    """Enriquece el Excel del trabajo; retorna (artefactos, resumen)."""
+    parametros = trabajo["parametros"]
+    directorio = cola.directorio(trabajo["id"])
+    ruta_excel = os.path.join(directorio, "entrada.xlsx")
+    registro = RegistroEjecucion()
+    cache = pipeline.CacheRespuestas(pipeline.RUTA_CACHE, parametros["cache_max_mb"], parametros["cache_max_dias"])
+    reportador = ReportadorProgreso(cola, trabajo["id"], registro, cache=None if parametros["omitir_cache"] else cache)
+
+    especificaciones = json.loads(trabajo["secreto"])
+    # El Excel siempre se exporta: el ensamblaje lee sus datos de ahí.
+    formatos = ["xlsx"] + [f for f in parametros.get("formatos", []) if f != "xlsx"]
+    pipeline.validar_formatos(formatos)
+    model = pipeline.crear_modelos_por_paso(
+        especificaciones, parametros["rpm"], parametros["tpm"], parametros.get("niveles")
+    )
+    reportador.actualizar(mensaje="Leyendo y limpiando el Excel...")
+    if parametros["lectura_por_bloques"]:
+        df = pipeline.leer_excel_por_bloques(ruta_excel, registro=registro, columnas=pipeline.columnas_usadas())
+    else:
+        df = pipeline.preparar_dataframe(ruta_excel, registro, pipeline.columnas_usadas())
+
+    # Cada trabajo escribe su propio checkpoint, así dos trabajos sobre el mismo libro no se pisan. En su
+    # primer arranque parte del último checkpoint del libro (si se pidió reanudar o reprocesar fallidas);
+    # si el trabajo se reencola tras una interrupción, el archivo ya existe y continúa desde él.
+    with open(ruta_excel, "rb") as f:
+        checkpoint_libro = pipeline.CheckpointEnriquecimiento.para_libro(f.read())
+    checkpoint = pipeline.CheckpointEnriquecimiento(os.path.join(directorio, ARCHIVO_CHECKPOINT))
+    if not os.path.exists(checkpoint.ruta):
+        checkpoint.sembrar(checkpoint_libro if parametros["reanudar"] or parametros["solo_fallidas"] else None)
+
+    restauradas = [0]
+
+    def al_iniciar(pendientes, restauradas_hasta_ahora):
+        restauradas[0] = restauradas_hasta_ahora
+        aviso = f" ({restauradas_hasta_ahora} filas restauradas del checkpoint)" if restauradas_hasta_ahora else ""
+        reportador.actualizar(total=pendientes, mensaje=f"Procesando ítems{aviso}...")
+
+    def al_completar(i, item_id, resultado, error):
+        reportador.item(i, item_id, error)
+
+    estadisticas_lote = pipeline.EstadisticasLote()
+    plan_deduplicacion = pipeline.PlanDeduplicacion()
+    enriquecer = pipeline.enriquecer_por_bloques if parametros["lectura_por_bloques"] else pipeline.enriquecer_dataframe
+    try:
+        df = enriquecer(
+            model, df, None, parametros["max_trabajadores"],
+            al_completar=al_completar, cache=cache, leer_cache=not parametros["omitir_cache"],
+            checkpoint=checkpoint, solo_fallidas=parametros["solo_fallidas"], al_iniciar=al_iniciar,
+            tamano_lote=parametros["tamano_lote"], estadisticas_lote=estadisticas_lote,
+            reintentos=pipeline.PoliticaReintentos(max_reintentos=parametros["max_reintentos"]), registro=registro,
+            deduplicar=parametros["deduplicar"], plan_deduplicacion=plan_deduplicacion,
+            streaming=pipeline.ConfiguracionStreaming(reportador.fragmento) if parametros.get("streaming") else None,
+        )
+    finally:
+        # El avance queda disponible para reanudar desde el libro en un trabajo posterior.
+        checkpoint.publicar(checkpoint_libro)
+
+    datos = pipeline.version_dataframe(df)
+    previo = exportacion_anterior(cola, datos)
+    if previo is not None:
+        reportador.anotar(f"Datos sin cambios respecto del trabajo {previo['id']}: se copiarán sus exportaciones")
+    reportador.actualizar(mensaje="Exportando los datos enriquecidos...", forzar=True)
+    exportacion = pipeline.exportar_formatos(
+        df, os.path.join(directorio, "enriquecido"), formatos, registro, datos=datos,
+        previo=os.path.join(cola.directorio(previo["id"]), "enriquecido") if previo is not None else None,
+    )
+    registro.exportar_json(os.path.join(directorio, "traza.json"))
+    registro.exportar_csv(os.path.join(directorio, "traza.csv"))
+    artefactos = {"traza_json": "traza.json", "traza_csv": "traza.csv"}
+    for formato, ruta in exportacion["rutas"].items():
+        artefactos["excel" if formato == "xlsx" else formato] = os.path.basename(ruta)
+    resumen = {
+        "version_datos": datos,
+        "exportaciones_reutilizadas": exportacion["reutilizados"],
+        "filas": len(df),
+        "restauradas": restauradas[0],
+        "filas_fallidas": len(pipeline.filas_fallidas(df)),
+        "columnas": [str(c) for c in df.columns],
+        "metricas": registro.resumen(),
+        "lote": estadisticas_lote.resumen() if parametros["tamano_lote"] > 1 else None,
+        "deduplicacion": plan_deduplicacion.resumen(),
+        "clientes": model.estadisticas(),
+        "cache": None if parametros["omitir_cache"] else {"aciertos": cache.aciertos, "fallos": cache.fallos},
+    }
+    return artefactos, resumen
+
+
+def ejecutar_ensamblaje(cola, trabajo):
+    """Ensambla las fichas a partir del Excel de un trabajo de enriquecimiento; retorna (artefactos, resumen)."""
+    parametros = trabajo["parametros"]
+    directorio = cola.directorio(trabajo["id"])
+    origen = cola.obtener(parametros["origen"])
+    if origen is None or origen["estado"] != COMPLETADO:
+        raise ValueError(f"El trabajo de enriquecimiento {parametros['origen']} no existe o no ha terminado.")
+
+    with open(os.path.join(directorio, "plantilla.docx"), "rb") as f:
+        plantilla_bytes = f.read()
+    registro = RegistroEjecucion()
+    reportador = ReportadorProgreso(cola, trabajo["id"], registro)
+    reportador.actualizar(mensaje="Preparando los datos de las fichas...")
+    df = pipeline.preparar_dataframe(
+        cola.ruta_artefacto(origen, "excel"), registro, pipeline.columnas_usadas(plantilla_bytes)
+    )
+
+    plantilla = hashlib.sha256(plantilla_bytes).hexdigest()
+    previo = ensamblaje_anterior(cola, plantilla) if parametros.get("incremental", True) else None
+    if previo is not None:
+        reportador.anotar(f"Se reutilizarán las fichas sin cambios del ensamblaje {previo['id']}")
+
+    reportador.actualizar(0, len(df), mensaje="Ensamblando las fichas...")
+    ruta_zip = os.path.join(directorio, "fichas.zip")
+    conteo = pipeline.ensamblar_fichas(
+        df, plantilla_bytes, parametros["columna"], ruta_zip,
+        al_avanzar=lambda n, total: reportador.actualizar(n, total),
+        procesos=parametros["procesos"],
+        compresion=zipfile.ZIP_STORED if parametros["sin_compresion"] else zipfile.ZIP_DEFLATED,
+        registro=registro, previo=cola.ruta_artefacto(previo, "zip") if previo is not None else None,
+    )
+    artefactos = {"zip": "fichas.zip", "manifiesto": os.path.basename(pipeline.ruta_manifiesto(ruta_zip))}
+    resumen = {
+        **conteo, "plantilla": plantilla, "previo": previo["id"] if previo is not None else None,
+        "metricas": registro.resumen(),
+    }
+    return artefactos, resumen
+
+
+def exportacion_anterior(cola, datos, limite=50):
+    """Enriquecimiento completado más reciente con la misma versión de los datos, o None."""
+    for trabajo in cola.listar(limite):
+        if trabajo["tipo"] != ENRIQUECIMIENTO or trabajo["estado"] != COMPLETADO:
+            continue
+        if (trabajo["resumen"] or {}).get("version_datos") == datos:
+            return trabajo
+    return None
+
+
+def ensamblaje_anterior(cola, plantilla, limite=50):
+    """Ensamblaje completado más reciente con la misma plantilla y cuyo .zip aún existe, o None."""
+    for trabajo in cola.listar(limite):
+        if trabajo["tipo"] != ENSAMBLAJE or trabajo["estado"] != COMPLETADO:
+            continue
+        if (trabajo["resumen"] or {}).get("plantilla") != plantilla:
+            continue
+        ruta = cola.ruta_artefacto(trabajo, "zip")
+        if ruta is not None and os.path.exists(ruta) and os.path.exists(pipeline.ruta_manifiesto(ruta)):
+            return trabajo
+    return None
+
+
+EJECUTORES = {
+    ENRIQUECIMIENTO: ejecutar_enriquecimiento,
+    ENSAMBLAJE: ejecutar_ensamblaje,
+}
+
+
+def ejecutar_trabajo(cola, trabajo):
+    """Ejecuta un trabajo ya tomado de la cola y registra su resultado o su error."""
+    try:
+        artefactos, resumen = EJECUTORES[trabajo["tipo"]](cola, trabajo)
+    except Exception as e:
+        traceback.print_exc()
+        cola.fallar(trabajo["id"], f"{type(e).__name__}: {e}")
+    else:
+        cola.completar(trabajo["id"], artefactos, resumen)
+
+# --- PROCESO TRABAJADOR ---
+
+def ejecutar_trabajador(cola, intervalo=1.0, max_inactividad=600.0, dias_retencion=DIAS_RETENCION):
+    """Bucle del trabajador: toma trabajos de la cola y ejecuta hasta `max_paralelos` a la vez.
+
+    Termina tras `max_inactividad` segundos sin trabajos (0 = en cuanto la cola se vacía); la interfaz
+    vuelve a lanzarlo con `asegurar_trabajador` al encolar el siguiente. Al iniciar y cada
+    `INTERVALO_PURGA` segundos borra los trabajos terminados hace más de `dias_retencion` días.
+    """
+    pid = os.getpid()
+    if not cola.registrar_trabajador(pid):
+        print("Ya hay un trabajador activo; este proceso termina.", file=sys.stderr)
+        return
+    reencolados = cola.reencolar_interrumpidos()
+    if reencolados:
+        print(f"{reencolados} trabajos interrumpidos vuelven a la cola.", file=sys.stderr)
+
+    en_curso = set()
+    ultima_actividad = time.monotonic()
+    ultima_purga = None
+    executor = ThreadPoolExecutor(max_workers=64)
+    try:
+        while True:
+            if ultima_purga is None or time.monotonic() - ultima_purga >= INTERVALO_PURGA:
+                ultima_purga = time.monotonic()
+                purgados = cola.purgar(dias_retencion)
+                if purgados:
+                    print(f"{purgados} trabajos terminados hace más de {dias_retencion:g} días se borraron.", file=sys.stderr)
+            max_paralelos = cola.latido(pid)
+            en_curso = {futuro for futuro in en_curso if not futuro.done()}
+            while len(en_curso) < max_paralelos:
+                trabajo = cola.tomar()
+                if trabajo is None:
+                    break
+                print(f"Trabajo {trabajo['id']} ({trabajo['tipo']}) iniciado.", file=sys.stderr)
+                en_curso.add(executor.submit(ejecutar_trabajo, cola, trabajo))
+            if en_curso:
+                ultima_actividad = time.monotonic()
+            elif time.monotonic() - ultima_actividad >= max_inactividad:
+                break
+            time.sleep(intervalo)
+    finally:
+        executor.shutdown(wait=True)
+        cola.liberar_trabajador(pid)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Proceso trabajador que ejecuta los trabajos en cola.")
+    parser.add_argument("--directorio", default=DIRECTORIO_TRABAJOS, help="Carpeta de la cola y de los trabajos.")
+    parser.add_argument("--paralelos", type=int, help="Fija el número máximo de trabajos en paralelo.")
+    parser.add_argument("--max-inactividad", type=float, default=600.0,
+                        help="Segundos sin trabajos tras los que el proceso termina (0 = al vaciarse la cola).")
+    parser.add_argument("--dias-retencion", type=float, default=DIAS_RETENCION,
+                        help="Días que se conservan los trabajos terminados y sus archivos (0 = sin límite).")
+    args = parser.parse_args(argv)
+
+    cola = ColaTrabajos(args.directorio)
+    if args.paralelos:
+        cola.configurar(args.paralelos)
+    ejecutar_trabajador(cola, max_inactividad=args.max_inactividad, dias_retencion=args.dias_retencion)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())